@@ -18,7 +18,8 @@
     |__________________________________________________________________________________________________________________|
 
     Version:
-        For now version is 1
+        The low byte is the format of this packet, 1 here; The high byte is the highest format the sender can
+        read, or 0 if it only reads format 1. See Wire Format v2.
     
     Type:
         1: Register
@@ -26,9 +27,11 @@
         3: Join
         4: Message
         5: Reunion
+        6: Replicate
+        7: Bundle
                 e.g: type = '2' => Advertise packet.
     Length:
-        This field shows the character numbers for Body of the packet.
+        This field shows the number of bytes in the UTF-8 encoded Body of the packet.
 
     Server IP/Port:
         We need this field for response packet in non-blocking mode.
@@ -49,6 +52,45 @@
 
 
 
+                                                **  Wire Format v2  **
+     __________________________________________________________________________________________________________________
+    |           Version(2 Bytes)         |  Type(1 Byte)  |          Source Server IP(4 Bytes)          | Port(2 Bytes) |
+    |------------------------------------------------------------------------------------------------------------------|
+    |                                              Length(Varint, 1-5 Bytes)                                           |
+    |------------------------------------------------------------------------------------------------------------------|
+    |                                                    ..........                                                    |
+    |                                                       BODY                                                       |
+    |                                                    ..........                                                    |
+    |__________________________________________________________________________________________________________________|
+
+    A more compact encoding of the same packets, only used on the wire: the framer turns every v2 packet it receives
+    into the format above, so the rest of the program never sees it.
+
+    Negotiation:
+        Every packet we send carries the highest format we can read in the high byte of its Version. A peer only
+        sends v2 packets to a neighbour once a packet from that neighbour said it reads v2, and forgets it when the
+        connection is closed; Peers that only know format 1 send Version 1, so they never get v2 packets.
+
+    Varint:
+        Unsigned LEB128: 7 bits per byte, least significant first, the high bit set on all bytes but the last.
+
+    Body:
+        The first byte is the kind of the body: 0 for a body copied as it is, otherwise the index + 1 of its kind
+        in REQ, RES, AGG, ACK, JOIN, QUIT, SNP, LOG, BET. The rest depends on the kind:
+            Register Request, Advertise Response:       the address in 6 bytes, see Node.pack_address.
+            Reunion Hello and Hello Back:               varint number of entries, the entries in 6 bytes each and a
+                                                        varint RTT + 1 (Hello) or interval + 1 (Hello Back), 0 if
+                                                        there is none.
+            Reunion Summary:                            varint number of entries; each entry is a varint of the
+                                                        difference of its packed address to the previous one and a
+                                                        varint hop RTT + 1, 0 if it is not known. The entries are
+                                                        sorted by their packed addresses.
+            Reunion Summary Back:                       the age as a zigzag varint.
+            Every other kind:                           the rest of the body as it is.
+        Messages, and bodies that don't encode back to exactly the same bytes, are copied as they are.
+
+
+
 
     Packet descriptions:
     
@@ -72,11 +114,17 @@
                  _________________________________________________
                 |                  RES (3 Chars)                  |
                 |-------------------------------------------------|
-                |                  ACK (3 Chars)                  |
+                |              ACK or NAK (3 Chars)               |
+                |-------------------------------------------------|
+                |           Fan-out (2 Chars, optional)           |
                 |_________________________________________________|
                 
                 For now only should just send an 'ACK' from the root to inform a node that it
                 has been registered in the root if the 'Register Request' was successful.
+                The root sends a 'NAK' to a node that advertises without being registered, e.g. because its
+                registration expired; The node goes back to newborn, so it can register again.
+                Fan-out is the maximum number of children of a peer in this network; The node takes it in place of
+                its own, so all of the peers agree with the root about how many children each of them may have.
                 
         Advertise:
             Request:
@@ -112,6 +160,9 @@
             to tell him that they should connect together; When receiving this packet we should update our
             Client Dictionary in the Stream object.
 
+            A node that the root moves to another parent sends a Join packet with 'QUIT' as the body to its
+            old parent, so the old parent drops it from its children.
+
 
             
         Message:
@@ -144,11 +195,18 @@
                 |                 IPN (15 Chars)                 |
                 |------------------------------------------------|
                 |                PortN (5 Chars)                 |
+                |------------------------------------------------|
+                |           RTT (8 Chars, optional)              |
                 |________________________________________________|
                 
-                In every interval (for now 20 seconds) peers must send this message to the root.
-                Every other peer that received this packet should append their (IP, port) to
-                the packet and update Length.
+                In every interval (advertised by the root, see Hello Back) peers must send this message to
+                the root, with themselves as the only entry. Every other peer that received this packet relays
+                it to its parent as it is, with only the Source Server IP/Port changed, and remembers which child the
+                Hello of IP0 came from. Older peers appended their (IP, port) to the entries; IP0/Port0 is
+                the sender of the Hello either way.
+
+                RTT is the round trip time of the previous Hello of IP0 in microseconds, zero padded.
+                Peers that don't know it only read the entries, so they ignore it.
 
             Hello Back:
         
@@ -171,18 +229,312 @@
                 |                 IP0 (15 Chars)                 |
                 |------------------------------------------------|
                 |                Port0 (5 Chars)                 |
+                |------------------------------------------------|
+                |          Interval (4 Chars, optional)          |
                 |________________________________________________|
 
                 Root in an answer to the Reunion Hello message will send this packet to the target node.
-                In this packet, all the nodes (IP, port) exist in order by path traversal to target.
+                It has only one entry, the target: every peer on the way relays it to the child that the
+                Hello of the target came from. Older roots put all the nodes (IP, port) on the path to the
+                target in it, in order; the target is the last entry either way.
+
+                Interval is the time the root asks the target to wait between its Hellos, in tenths of a
+                second, zero padded; See Peer.reunion_target_rate.
+
+            Summary:
+
+                                    ** Body Format **
+                 ________________________________________________
+                |                  AGG (3 Chars)                 |
+                |------------------------------------------------|
+                |           Number of Entries (5 Chars)          |
+                |------------------------------------------------|
+                |           Packed Address0 (12 Chars)           |
+                |------------------------------------------------|
+                |                Hop RTT0 (8 Chars)              |
+                |------------------------------------------------|
+                |                     ...                        |
+                |________________________________________________|
+
+                The Hello of aggregated reunion mode. Instead of forwarding the Hellos of its sub-tree one by one,
+                every peer collects the peers that reported to it since its last Summary and sends them to its parent
+                in one Summary, itself included; So the root gets one packet per child and period.
+
+                The entries are sorted by Packed Address, which is Node.pack_address of a peer in hex, zero padded.
+                Hop RTT is the round trip time between the peer and its parent in microseconds, zero padded, or
+                '--------' if it is not known yet.
+
+            Summary Back:
+
+                                    ** Body Format **
+                 ________________________________________________
+                |                  ACK (3 Chars)                 |
+                |------------------------------------------------|
+                |                  Age (4 Chars)                 |
+                |________________________________________________|
+
+                The parent answers every Summary right away, as long as it is joined. Age is the parent's own reunion
+                timer in ticks, e.g. '-004' from the root: how long ago the root last heard of the path from the root
+                to the parent; The child takes it as its own reunion timer.
+
+        Replicate:
+
+                                ** Body Format **
+                 ________________________________________________
+                |          REQ, SNP, LOG or BET (3 Chars)        |
+                |------------------------------------------------|
+                |            Data (binary, #Length - 3)          |
+                |________________________________________________|
+
+            Between the root and its standby roots. A standby sends REQ to the root when it starts; the root
+            answers with SNP, a snapshot of its state, and then sends every change of its state in LOG packets
+            (see GraphJournal for both formats) and BET, with no data, once per tick so the standby knows it is
+            alive.
+
+        Bundle:
+
+                                ** Body Format **
+                 ________________________________________________
+                |            Packet 0 (as sent on its own)       |
+                |------------------------------------------------|
+                |                      ....                      |
+                |------------------------------------------------|
+                |            Packet n (as sent on its own)       |
+                |________________________________________________|
+
+            Several packets for the same neighbour in one frame, so they cost a single header and a single ACK. The
+            packets are in the format they would be sent in on their own, one after the other; The receiver takes
+            them out with a PacketFramer and handles each one like any other packet. Only sent to neighbours that
+            read Wire Format v2.
             
     
 """
 
+import functools
 import struct
 
 from src.tools.Node import Node
 
+# Size of the fixed packet header in bytes.
+HEADER_SIZE = 20
+# Version, Type, Length, the 4 parts of the IP and the Port.
+_HEADER = struct.Struct('!hhl4hl')
+# Only the Source Server IP/Port part of the header.
+_SOURCE_FIELDS = struct.Struct('!4hl')
+_SOURCE_OFFSET = 8
+# Largest RTT a Reunion Hello can carry, in microseconds.
+_MAX_RTT = 99999999
+
+
+@functools.lru_cache(maxsize=1024)
+def _address_fields(ip, port):
+    # The 4 IP parts and the port as header fields; the same few addresses are encoded over and over.
+    return tuple(int(part) for part in ip.split('.')) + (int(port),)
+
+# The Length field sits right after Version and Type.
+_LENGTH_FIELD = struct.Struct('!l')
+_LENGTH_OFFSET = 4
+
+# The formats we can read; Version is the format in the low byte and the highest readable one in the high byte.
+WIRE_V1 = 1
+WIRE_V2 = 2
+_VERSION_FIELD = struct.Struct('!H')
+# Header of the v2 format, up to the Length varint.
+_V2_HEADER = struct.Struct('!HB4BH')
+_V2_KINDS = ('REQ', 'RES', 'AGG', 'ACK', 'JOIN', 'QUIT', 'SNP', 'LOG', 'BET')
+
+
+def wire_version_field(layout, readable):
+    """
+    :param layout: Format of the packet.
+    :param readable: Highest format the sender reads.
+
+    :return: The Version field of the packet.
+    :rtype: int
+    """
+    return (readable << 8 if readable > WIRE_V1 else 0) | layout
+
+
+def wire_readable(version):
+    """
+    :param version: Version field of a received packet.
+
+    :return: The highest format its sender reads.
+    :rtype: int
+    """
+    return max(version >> 8, version & 255)
+
+
+def wire_version_of(buf):
+    """
+    :param buf: A packet in any format.
+
+    :return: Its Version field.
+    :rtype: int
+    """
+    return _VERSION_FIELD.unpack_from(buf)[0]
+
+
+def set_wire_version(buf, version):
+    """
+    :param buf: A packet in format 1.
+    :param version: The new Version field.
+
+    :return: The packet with 'version'; 'buf' itself if it is a bytearray, otherwise a copy.
+    :rtype: bytearray
+    """
+    if not isinstance(buf, bytearray):
+        buf = bytearray(buf)
+    _VERSION_FIELD.pack_into(buf, 0, version)
+    return buf
+
+
+def source_key_of(buf):
+    """
+    :param buf: A packet in format 1.
+
+    :return: Node.pack_address of its source server address, read straight from the header.
+    :rtype: int
+    """
+    fields = _SOURCE_FIELDS.unpack_from(buf, _SOURCE_OFFSET)
+    return (fields[0] << 40) | (fields[1] << 32) | (fields[2] << 24) | (fields[3] << 16) | fields[4]
+
+
+def _put_varint(out, value):
+    while value > 127:
+        out.append((value & 127) | 128)
+        value >>= 7
+    out.append(value)
+
+
+def _get_varint(buf, offset):
+    # The value and the offset after it; None if the varint is not complete yet.
+    value = 0
+    shift = 0
+    while offset < len(buf):
+        byte = buf[offset]
+        offset += 1
+        value |= (byte & 127) << shift
+        if byte < 128:
+            return value, offset
+        shift += 7
+    return None, offset
+
+
+def _put_address(out, text):
+    # 'IP (15 Chars)' + 'Port (5 Chars)' as 6 bytes.
+    out += Node.pack_address((text[0:15], text[15:20])).to_bytes(6, 'big')
+
+
+def _get_address(buf, offset):
+    address = Node.unpack_address(int.from_bytes(buf[offset:offset + 6], 'big'))
+    return address[0] + address[1]
+
+
+def _encode_v2_body(type, body):
+    # Bytes of the v2 body; see Wire Format v2.
+    kind_size = 4 if type == 3 else 3
+    kind = body[:kind_size].decode('ascii', 'replace')
+    if type == 4 or kind not in _V2_KINDS:
+        return b'\x00' + body
+    rest = body[kind_size:].decode('ascii', 'replace')
+    out = bytearray([_V2_KINDS.index(kind) + 1])
+    if (type == 1 and kind == 'REQ') or (type == 2 and kind == 'RES'):
+        _put_address(out, rest)
+    elif type == 5 and kind in ('REQ', 'RES'):
+        count = int(rest[0:2])
+        _put_varint(out, count)
+        for i in range(count):
+            _put_address(out, rest[2 + 20 * i:22 + 20 * i])
+        tail = rest[2 + 20 * count:]
+        _put_varint(out, int(tail) + 1 if tail else 0)
+    elif type == 5 and kind == 'AGG':
+        count = int(rest[0:5])
+        _put_varint(out, count)
+        previous = 0
+        for i in range(count):
+            entry = rest[5 + 20 * i:25 + 20 * i]
+            key = int(entry[0:12], 16)
+            _put_varint(out, key - previous)
+            _put_varint(out, int(entry[12:20]) + 1 if entry[12:20].isdigit() else 0)
+            previous = key
+    elif type == 5 and kind == 'ACK':
+        age = int(rest)
+        _put_varint(out, age * 2 if age >= 0 else -age * 2 - 1)
+    else:
+        out += body[kind_size:]
+    return bytes(out)
+
+
+def _decode_v2_body(type, body):
+    # Inverse of _encode_v2_body.
+    if not body or body[0] == 0:
+        return bytes(body[1:])
+    kind = _V2_KINDS[body[0] - 1]
+    if (type == 1 and kind == 'REQ') or (type == 2 and kind == 'RES'):
+        return (kind + _get_address(body, 1)).encode('ascii')
+    if type == 5 and kind in ('REQ', 'RES'):
+        count, offset = _get_varint(body, 1)
+        parts = [kind, str(count).zfill(2)]
+        for i in range(count):
+            parts.append(_get_address(body, offset))
+            offset += 6
+        tail, offset = _get_varint(body, offset)
+        if tail:
+            parts.append(str(tail - 1).zfill(8 if kind == 'REQ' else 4))
+        return ''.join(parts).encode('ascii')
+    if type == 5 and kind == 'AGG':
+        count, offset = _get_varint(body, 1)
+        parts = [kind, str(count).zfill(5)]
+        key = 0
+        for i in range(count):
+            delta, offset = _get_varint(body, offset)
+            rtt, offset = _get_varint(body, offset)
+            key += delta
+            parts.append('%012x' % key)
+            parts.append(str(rtt - 1).zfill(8) if rtt else '--------')
+        return ''.join(parts).encode('ascii')
+    if type == 5 and kind == 'ACK':
+        age, _ = _get_varint(body, 1)
+        return (kind + '%04d' % (age // 2 if age % 2 == 0 else -(age + 1) // 2)).encode('ascii')
+    return kind.encode('ascii') + bytes(body[1:])
+
+
+def encode_v2(buf, readable=WIRE_V2):
+    """
+    :param buf: A packet in format 1.
+    :param readable: The highest format we read, for the Version field.
+
+    :return: The same packet in format 2.
+    :rtype: bytearray
+    """
+    header = _HEADER.unpack_from(buf)
+    body = bytes(buf[HEADER_SIZE:HEADER_SIZE + header[2]])
+    try:
+        compact = _encode_v2_body(header[1], body)
+        # Anything that doesn't come back the same, e.g. a body with unusual padding, is copied as it is.
+        if _decode_v2_body(header[1], compact) != body:
+            compact = b'\x00' + body
+    except (ValueError, IndexError, TypeError):
+        compact = b'\x00' + body
+    out = bytearray(_V2_HEADER.pack(wire_version_field(WIRE_V2, readable), header[1], *header[3:8]))
+    _put_varint(out, len(compact))
+    out += compact
+    return out
+
+
+def decode_v2(buf):
+    """
+    :param buf: A whole packet in format 2.
+
+    :return: The same packet in format 1; Its Version field is the one of the v2 packet.
+    :rtype: bytearray
+    """
+    fields = _V2_HEADER.unpack_from(buf)
+    length, offset = _get_varint(buf, _V2_HEADER.size)
+    body = _decode_v2_body(fields[1], buf[offset:offset + length])
+    return bytearray(_HEADER.pack(fields[0], fields[1], len(body), *fields[2:7])) + body
+
 
 class Packet:
 
@@ -192,33 +544,48 @@ class Packet:
         The decoded buffer should convert to a new packet.
 
         :param buf: Input buffer was just decoded.
+        :param length: Length field; the byte length of the encoded body if None.
+        :param body: Packet body, either str or UTF-8 encoded bytes.
         :type buf: bytes
         """
         if buf is not None:
             self.buf = buf
-            data = struct.unpack('!hhl4hl', bytes(buf[:20]))
-            # print(data)
+            data = _HEADER.unpack_from(buf)
             self.version = data[0]
             self.type = data[1]
             self.length = data[2]
-            ip_str_list = [str(i) for i in data[3:7]]
-            ip_str = ip_str_list[0] + '.' + ip_str_list[1] + '.' + ip_str_list[2] + '.' + ip_str_list[3]
-            self.source_server_ip = Node.parse_ip(ip_str)
-            self.source_server_port = Node.parse_port(str(data[7]))
-            rest = struct.unpack('%dB' % len(buf[20:]), buf[20:])
-            self.body = ''.join(chr(i) for i in rest)
+            # Same format as Node.parse_ip / Node.parse_port, without the round trip through strings.
+            self.source_server_ip = '%03d.%03d.%03d.%03d' % data[3:7]
+            self.source_server_port = '%05d' % data[7]
+            with memoryview(buf) as view:
+                self.body_bytes = bytes(view[HEADER_SIZE:])
+            self._body = None
         else:
+            if isinstance(body, str):
+                self.body_bytes = body.encode('utf-8')
+                self._body = body
+            else:
+                self.body_bytes = body if isinstance(body, bytes) else bytes(body)
+                self._body = None
+            if length is None:
+                length = len(self.body_bytes)
             self.version = version
             self.type = type
             self.length = length
             self.source_server_ip = source_server_ip
             self.source_server_port = source_server_port
-            self.body = body
-            ip_int_list = list(map(int, self.source_server_ip.split('.')))
-            self.buf = struct.pack('!hhl4hl%dB' % len(body), version, type, length, *ip_int_list,
-                                   int(source_server_port), *bytes(body, 'utf-8'))
+            self.buf = bytearray(_HEADER.pack(version, type, length,
+                                              *_address_fields(source_server_ip, source_server_port)))
+            self.buf += self.body_bytes
         pass
 
+    @property
+    def body(self):
+        # The body is only decoded when someone asks for it as a string.
+        if self._body is None:
+            self._body = self.body_bytes.decode('utf-8', 'replace')
+        return self._body
+
     def get_header(self):
         """
 
@@ -264,6 +631,22 @@ class Packet:
         return self.body
         pass
 
+    def get_body_bytes(self):
+        """
+
+        :return: Packet body without decoding it.
+        :rtype: bytes
+        """
+        return self.body_bytes
+
+    def get_body_kind(self):
+        """
+
+        :return: The first 3 characters of the body, e.g. 'REQ' or 'RES'.
+        :rtype: str
+        """
+        return self.body_bytes[:3].decode('ascii', 'replace')
+
     def get_buf(self):
         """
         In this function, we will make our final buffer that represents the Packet with the Struct class methods.
@@ -302,6 +685,218 @@ class Packet:
         pass
 
 
+class PacketView:
+    """
+    A read-only packet over a received buffer.
+
+    It answers the same getters as Packet, but a field is only decoded when it is asked for for the first time:
+    the header on the first header getter, the formatted source address on the first address getter and the body
+    on get_body; get_body_kind only looks at the first 3 bytes of the body.
+    """
+    __slots__ = ('buf', '_header', '_source_server_address', '_body')
+
+    def __init__(self, buf):
+        """
+        :param buf: A whole packet.
+        :type buf: bytes or bytearray
+        """
+        self.buf = buf
+        self._header = None
+        self._source_server_address = None
+        self._body = None
+
+    def __get_header(self):
+        if self._header is None:
+            self._header = _HEADER.unpack_from(self.buf)
+        return self._header
+
+    def get_version(self):
+        """
+
+        :return: Packet Version
+        :rtype: int
+        """
+        return self.__get_header()[0]
+
+    def get_type(self):
+        """
+
+        :return: Packet type
+        :rtype: int
+        """
+        return self.__get_header()[1]
+
+    def get_length(self):
+        """
+
+        :return: Packet length
+        :rtype: int
+        """
+        return self.__get_header()[2]
+
+    def get_body(self):
+        """
+
+        :return: Packet body
+        :rtype: str
+        """
+        if self._body is None:
+            self._body = self.get_body_bytes().decode('utf-8', 'replace')
+        return self._body
+
+    def get_body_bytes(self):
+        """
+
+        :return: Packet body without decoding it.
+        :rtype: bytes
+        """
+        return bytes(self.buf[HEADER_SIZE:])
+
+    def get_body_kind(self):
+        """
+
+        :return: The first 3 characters of the body, e.g. 'REQ' or 'RES'.
+        :rtype: str
+        """
+        return bytes(self.buf[HEADER_SIZE:HEADER_SIZE + 3]).decode('ascii', 'replace')
+
+    def get_buf(self):
+        """
+
+        :return: The buffer this view is over.
+        :rtype: bytearray
+        """
+        return self.buf
+
+    def get_source_server_ip(self):
+        """
+
+        :return: Server IP address for the sender of the packet.
+        :rtype: str
+        """
+        return self.get_source_server_address()[0]
+
+    def get_source_server_port(self):
+        """
+
+        :return: Server Port address for the sender of the packet.
+        :rtype: str
+        """
+        return self.get_source_server_address()[1]
+
+    def get_source_server_address(self):
+        """
+
+        :return: Server address; The format is like ('192.168.001.001', '05335').
+        :rtype: tuple
+        """
+        if self._source_server_address is None:
+            header = self.__get_header()
+            self._source_server_address = ('%03d.%03d.%03d.%03d' % header[3:7], '%05d' % header[7])
+        return self._source_server_address
+
+    def set_source_server_address(self, address):
+        """
+        Overwrite the Source Server IP/Port header fields in place, e.g. before relaying the packet.
+        The rest of the buffer is neither decoded nor copied, so it costs the same for any body size.
+
+        :param address: New source address; The format is like ('192.168.001.001', '05335').
+        :type address: tuple
+
+        :return: This view, so the same buffer can be handed on.
+        :rtype: PacketView
+        """
+        if not isinstance(self.buf, bytearray):
+            self.buf = bytearray(self.buf)
+        _SOURCE_FIELDS.pack_into(self.buf, _SOURCE_OFFSET, *_address_fields(address[0], address[1]))
+        self._header = None
+        self._source_server_address = (Node.parse_ip(address[0]), Node.parse_port(address[1]))
+        return self
+
+
+class PacketFramer:
+    """
+    Reassembles the packets of a single TCP connection.
+
+    TCP delivers a byte stream, so one recv() may hold part of a packet or several of them.
+    The framer keeps the unfinished tail in a bytearray and cuts whole packets out of it
+    using the Length field of their header. Every packet gets its own bytearray, so a relaying
+    peer can patch its header in place (see PacketView.set_source_server_address).
+
+    Packets in the v2 wire format are turned into the usual format on the way out, see decode_v2.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, data):
+        """
+        Append the received data to the buffer and take out every packet it completed.
+
+        :param data: Bytes just received from the connection.
+        :type data: bytes
+
+        :return: Whole packets, each one a separate bytearray.
+        :rtype: list
+        """
+        buf = self._buf
+        buf += data
+        packets = []
+        start = 0
+        end = len(buf)
+        with memoryview(buf) as view:
+            while end - start >= _V2_HEADER.size:
+                if buf[start + 1] == WIRE_V2:
+                    length, offset = _get_varint(buf, start + _V2_HEADER.size)
+                    if length is None or end < offset + length:
+                        break
+                    packets.append(decode_v2(view[start:offset + length]))
+                    start = offset + length
+                    continue
+                if end - start < HEADER_SIZE:
+                    break
+                length = _LENGTH_FIELD.unpack_from(buf, start + _LENGTH_OFFSET)[0]
+                if length < 0:
+                    # The stream is out of sync; nothing after this point can be trusted.
+                    print("Invalid packet length received; dropping " + str(end - start) + " buffered bytes.")
+                    start = end
+                    break
+                size = HEADER_SIZE + length
+                if end - start < size:
+                    break
+                packets.append(bytearray(view[start:start + size]))
+                start += size
+        # Drop the consumed packets in one go; the tail stays for the next feed.
+        del buf[:start]
+        return packets
+
+    def pending(self):
+        """
+
+        :return: Number of buffered bytes that do not form a whole packet yet.
+        :rtype: int
+        """
+        return len(self._buf)
+
+
+def unbundle(buf):
+    """
+    :param buf: A received packet in format 1.
+    :type buf: bytearray
+
+    :return: The packets of a Bundle, or the packet itself for any other type.
+    :rtype: list
+    """
+    if _HEADER.unpack_from(buf)[1] != 7:
+        return [buf]
+    framer = PacketFramer()
+    with memoryview(buf) as view:
+        packets = framer.feed(view[HEADER_SIZE:])
+    if framer.pending():
+        print("Bundle with " + str(framer.pending()) + " trailing bytes; they are dropped.")
+    return packets
+
+
 class PacketFactory:
     """
     This class is only for making Packet objects.
@@ -311,26 +906,31 @@ class PacketFactory:
     def parse_buffer(buffer):
         """
         In this function we will make a new Packet from input buffer with struct class methods.
+        The fields are decoded lazily, see PacketView.
 
         :param buffer: The buffer that should be parse to a validate packet format
 
         :return new packet
-        :rtype Packet
+        :rtype PacketView
 
         """
-        return Packet(buf=buffer)
+        return PacketView(buffer)
         pass
 
     @staticmethod
-    def new_reunion_packet(type, source_address, nodes_array):
+    def new_reunion_packet(type, source_address, nodes_array, rtt=None, interval=None):
         """
         :param type: Reunion Hello (REQ) or Reunion Hello Back (RES)
         :param source_address: IP/Port address of the packet sender.
         :param nodes_array: [(ip0, port0), (ip1, port1), ...] It is the path to the 'destination'.
+        :param rtt: For a Reunion Hello, the measured round trip time of the previous Hello of ip0/port0 in seconds.
+        :param interval: For a Reunion Hello Back, the interval between Hellos that the root asks for in seconds.
 
         :type type: str
         :type source_address: tuple
         :type nodes_array: list
+        :type rtt: float
+        :type interval: float
 
         :return New reunion packet.
         :rtype Packet
@@ -341,14 +941,145 @@ class PacketFactory:
         for address in nodes_array:
             packet_body += Node.parse_ip(address[0])
             packet_body += Node.parse_port(address[1])
+        if type == 'REQ' and rtt is not None:
+            packet_body += str(min(int(rtt * 1e6), _MAX_RTT)).zfill(8)
+        if type == 'RES' and interval is not None:
+            packet_body += str(min(int(round(interval * 10)), 9999)).zfill(4)
         packet = None
         if type == 'REQ' or type == 'RES':
-            packet = Packet(None, 1, 5, 5 + 20 * len(nodes_array), source_address[0], source_address[1], packet_body)
+            packet = Packet(None, 1, 5, len(packet_body), source_address[0], source_address[1], packet_body)
         else:
             print("Invalid Reunion Packet Type!")
         return packet
         pass
 
+    @staticmethod
+    def parse_reunion_rtt(body):
+        """
+        :param body: Body of a Reunion Hello.
+        :type body: str
+
+        :return: The RTT field of the Hello in seconds, or None if it has none.
+        :rtype: float
+        """
+        end = 5 + 20 * int(body[3:5])
+        rtt = body[end:end + 8]
+        if len(rtt) != 8 or not rtt.isdigit():
+            return None
+        return int(rtt) / 1e6
+
+    @staticmethod
+    def parse_register_fan_out(body):
+        """
+        :param body: Body of a Register Response.
+        :type body: str
+
+        :return: The fan-out of the network, or None if the root didn't send it.
+        :rtype: int
+        """
+        fan_out = body[6:8]
+        if len(fan_out) != 2 or not fan_out.isdigit() or fan_out == '00':
+            return None
+        return int(fan_out)
+
+    @staticmethod
+    def parse_reunion_interval(body):
+        """
+        :param body: Body of a Reunion Hello Back.
+        :type body: str
+
+        :return: The interval field of the Hello Back in seconds, or None if it has none.
+        :rtype: float
+        """
+        end = 5 + 20 * int(body[3:5])
+        interval = body[end:end + 4]
+        if len(interval) != 4 or not interval.isdigit() or interval == '0000':
+            return None
+        return int(interval) / 10
+
+    @staticmethod
+    def new_reunion_summary_packet(source_address, entries):
+        """
+        :param source_address: IP/Port address of the packet sender.
+        :param entries: [(address0, hop_rtt0), ...]; The addresses of the peers in the sender's sub-tree that are alive,
+                        and their hop RTTs in seconds, or None.
+
+        :type source_address: tuple
+        :type entries: list
+
+        :return New reunion Summary packet.
+        :rtype Packet
+        """
+        parts = ['AGG', str(len(entries)).zfill(5)]
+        # Sorted by packed address, so the v2 format can send the differences of the addresses.
+        for key, rtt in sorted((Node.pack_address(address), rtt) for address, rtt in entries):
+            parts.append('%012x' % key)
+            parts.append('--------' if rtt is None else str(min(int(rtt * 1e6), _MAX_RTT)).zfill(8))
+        packet_body = ''.join(parts)
+        return Packet(None, 1, 5, len(packet_body), source_address[0], source_address[1], packet_body)
+
+    @staticmethod
+    def parse_reunion_summary(body):
+        """
+        :param body: Body of a reunion Summary.
+        :type body: str
+
+        :return: The entries of the Summary, [(address0, hop_rtt0), ...] like in new_reunion_summary_packet.
+        :rtype: list
+        """
+        entries = []
+        for i in range(int(body[3:8])):
+            entry = body[8 + 20 * i:28 + 20 * i]
+            rtt = entry[12:20]
+            entries.append((Node.unpack_address(int(entry[0:12], 16)), int(rtt) / 1e6 if rtt.isdigit() else None))
+        return entries
+
+    @staticmethod
+    def new_reunion_ack_packet(source_address, age):
+        """
+        :param source_address: IP/Port address of the packet sender.
+        :param age: The reunion timer of the sender in ticks.
+
+        :type source_address: tuple
+        :type age: int
+
+        :return New reunion Summary Back packet.
+        :rtype Packet
+        """
+        packet_body = 'ACK' + ('%04d' % max(-999, min(age, 9999)))
+        return Packet(None, 1, 5, len(packet_body), source_address[0], source_address[1], packet_body)
+
+    @staticmethod
+    def new_bundle_packet(source_server_address, buffers):
+        """
+        :param source_server_address: Server address of the packet sender.
+        :param buffers: Whole packets, each one as it would be sent on its own.
+
+        :type source_server_address: tuple
+        :type buffers: list
+
+        :return New bundle packet.
+        :rtype Packet
+        """
+        return Packet(None, 1, 7, None, source_server_address[0], source_server_address[1], b''.join(buffers))
+
+    @staticmethod
+    def new_replicate_packet(type, source_server_address, data=b''):
+        """
+        :param type: 'REQ', 'SNP', 'LOG' or 'BET'.
+        :param source_server_address: Server address of the packet sender.
+        :param data: The snapshot or the records.
+
+        :type type: str
+        :type source_server_address: tuple
+        :type data: bytes
+
+        :return New replicate packet.
+        :rtype Packet
+        """
+        return Packet(None, 1, 6, None, source_server_address[0], source_server_address[1],
+                      type.encode('ascii') + data)
+
     @staticmethod
     def new_advertise_packet(type, source_server_address, neighbour=None):
         """
@@ -381,32 +1112,37 @@ class PacketFactory:
         pass
 
     @staticmethod
-    def new_join_packet(source_server_address):
+    def new_join_packet(source_server_address, leave=False):
         """
         :param source_server_address: Server address of the packet sender.
+        :param leave: Make a 'QUIT' packet for leaving the parent instead.
 
         :type source_server_address: tuple
+        :type leave: bool
 
         :return New join packet.
         :rtype Packet
 
         """
-        packet = Packet(None, 1, 3, 4, source_server_address[0], source_server_address[1], 'JOIN')
+        packet = Packet(None, 1, 3, 4, source_server_address[0], source_server_address[1],
+                        'QUIT' if leave else 'JOIN')
         return packet
         pass
 
     @staticmethod
-    def new_register_packet(type, source_server_address, address=(None, None)):
+    def new_register_packet(type, source_server_address, address=(None, None), fan_out=None, ack=True):
         """
-        #FIXME It should be possible to set ACK for RES type. For example and registered client tries to register via sending a register pack , root should be able to send an ACK=False respond register packet
-        #TODO FIX it
         :param type: Type of Register packet - Either 'REQ' or 'RES'
         :param source_server_address: Server address of the packet sender.
         :param address: If 'type' is 'request' we need an address; The format is like ('192.168.001.001', '05335').
+        :param fan_out: For 'RES', the fan-out of the network.
+        :param ack: For 'RES', False tells the node that it is not registered.
 
         :type type: str
         :type source_server_address: tuple
         :type address: tuple
+        :type fan_out: int
+        :type ack: bool
 
         :return New Register packet.
         :rtype Packet
@@ -419,8 +1155,11 @@ class PacketFactory:
             packet_body = packet_body + source_server_address[0] + source_server_address[1]
             packet = Packet(None, 1, 1, 23, source_server_address[0], source_server_address[1], packet_body)
         elif type == 'RES':
-            packet_body += 'ACK'
-            packet = Packet(None, 1, 1, 6, source_server_address[0], source_server_address[1], packet_body)
+            packet_body += 'ACK' if ack else 'NAK'
+            if fan_out is not None:
+                packet_body += str(fan_out).zfill(2)
+            packet = Packet(None, 1, 1, len(packet_body), source_server_address[0], source_server_address[1],
+                            packet_body)
         else:
             print("Invalid Register Packet Type!")
         return packet
@@ -434,12 +1173,14 @@ class PacketFactory:
         :param message: Our message
         :param source_server_address: Server address of the packet sender.
 
-        :type message: str
+        :type message: str or bytes
         :type source_server_address: tuple
 
         :return New Message packet.
         :rtype: Packet
         """
+        if isinstance(message, str):
+            message = message.encode('utf-8')
         packet = Packet(None, 1, 4, len(message), source_server_address[0], source_server_address[1], message)
         return packet
         pass
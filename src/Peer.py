@@ -1,8 +1,13 @@
 from src.Stream import Stream
-from src.Packet import Packet, PacketFactory
+from src.Packet import Packet, PacketFactory, WIRE_V2
 from src.UserInterface import UserInterface
 from src.tools.Node import Node
 from src.tools.NetworkGraph import NetworkGraph, GraphNode
+from src.tools.GraphJournal import GraphJournal
+from src.tools.Registry import Registry
+from src.tools.ReunionScheduler import ReunionScheduler
+from collections import OrderedDict
+import threading
 import time
 
 
@@ -16,7 +21,9 @@ import time
 
 class Peer:
 
-    def __init__(self, server_ip, server_port, is_root=False, root_address=None):
+    def __init__(self, server_ip, server_port, is_root=False, root_address=None, fan_out=2, journal_path=None,
+                 standby=False, fallback_roots=None, aggregate_reunion=False, reunion_target_rate=None,
+                 wire_version=WIRE_V2):
 
         """
         The Peer object constructor.
@@ -38,47 +45,191 @@ class Peer:
         :param server_port: Server Port address for this Peer that should be pass to Stream.
         :param is_root: Specify that is this Peer root or not.
         :param root_address: Root IP/Port address if we are a client.
+        :param fan_out: Maximum number of children of a Peer; The root sends its own to the clients when they
+                        register, so it is only used until then by a client.
+        :param journal_path: For the root, where to keep its state (see GraphJournal), so it can be restarted
+                             without the network starting over; None keeps it only in memory.
+        :param standby: Be a standby for the root at root_address: keep a copy of its state and take its place
+                        if it stops responding.
+        :param fallback_roots: For a client, addresses of standby roots to turn to if the root is lost.
+        :param aggregate_reunion: Send reunion Summaries instead of Hellos, see send_reunion_client.
+        :param reunion_target_rate: For the root, the number of Reunion Hellos per second it wants to receive; It
+                                    adjusts the interval it advertises to the peers to keep to it. None keeps the
+                                    interval fixed.
+        :param wire_version: Highest wire format we use; Neighbours that read format 2 get it, see Wire Format v2
+                             in Packet. 1 keeps to the usual format.
 
         :type server_ip: str
         :type server_port: int
         :type is_root: bool
         :type root_address: tuple
+        :type fan_out: int
+        :type journal_path: str
+        :type standby: bool
+        :type fallback_roots: list
+        :type aggregate_reunion: bool
+        :type reunion_target_rate: float
+        :type wire_version: int
         """
         self.time_out = 40
-        self.user_interface = UserInterface()
+        # Length of one timer tick in seconds; time_out and connection_timer are counted in ticks.
+        self.tick_interval = 1
+        # Set by the Stream and the UserInterface whenever there is something for the main loop to do.
+        self.wakeup = threading.Event()
         self.server_ip = Node.parse_ip(server_ip)
         self.server_port = Node.parse_port(str(server_port))
         self.is_root = is_root
 
-        self.stream = Stream(ip=server_ip, port=server_port)
-        self.user_interface = UserInterface()
+        self.stream = Stream(ip=server_ip, port=server_port, wakeup=self.wakeup, wire_version=wire_version)
+        self.user_interface = UserInterface(wakeup=self.wakeup)
         self.registered = False
         self.state = 'newborn'
 
         self.life = False  # while self.life : run
-        self.counter = 0  # when to send in run
         self.parent_address = None
-        self.left_child = None
-        self.right_child = None
+        # Addresses of our children, in the order they joined; at most fan_out of them.
+        self.fan_out = fan_out
+        self.children = []
         self.reunion_on_fly = False
         self.connection_timer = None
+        # An unanswered Hello is sent again after reunion_retry ticks, because it may have been lost with a parent
+        # that failed and has been replaced; The wait doubles with every further miss.
+        self.reunion_retry = 8
+        # When to send Reunion Hellos; The interval between them is advertised by the root in its Hello Backs.
+        # As the root, reunion_arrivals counts the Hellos of the current tick and reunion_rate is their average rate.
+        self.reunion_interval = (2 if aggregate_reunion else 4) * self.tick_interval
+        self.reunion_target_rate = reunion_target_rate
+        self.reunion_arrivals = 0
+        self.reunion_rate = 0.0
+        self.reunion_scheduler = ReunionScheduler(interval=self.reunion_interval, min_interval=self.tick_interval,
+                                                  max_interval=self.time_out * self.tick_interval / 4,
+                                                  retry=self.reunion_retry * self.tick_interval,
+                                                  max_retry=self.time_out * self.tick_interval / 2)
+        # When our last Reunion Hello was sent, and the measured round trip time of the last answered one in seconds;
+        # The RTT is reported to the root in the next Hello, for placing nodes near the root.
+        self.reunion_sent_at = None
+        self.reunion_rtt = None
+        # In aggregated reunion mode: the peers of our sub-tree that reported since our last Summary, with their hop
+        # RTTs, and our own hop RTT.
+        self.aggregate_reunion = aggregate_reunion
+        self.reunion_entries = {}
+        self.reunion_hop_rtt = None
+        # For relaying Reunion Hello Backs: the child that every Hello of our sub-tree came from, by its origin.
+        self.reunion_routes = {}
+        # The root rebalances the tree every rebalance_interval ticks, moving at most rebalance_moves nodes each time.
+        self.rebalance_interval = 4
+        self.rebalance_moves = 1
+        self.ticks = 0
+        self.journal = None
+        # Ticks since we lost the connection to the root, while it is lost; The root may be restarting.
+        self.root_lost_ticks = None
+        self.journal_path = journal_path
+        # As the root, addresses of our standby roots; As a standby, ticks since the root was last heard of.
+        # A standby takes over after standby_timeout silent ticks, and clients try their fallback roots after the
+        # root is lost for as long, so the network has a root again within one reunion timeout.
+        self.standby = standby
+        self.standbys = []
+        # As the root, the register connections of the peers whose registration expired lately, by their packed
+        # addresses and oldest first; They are kept so those peers can be told to register again, but only the last
+        # recently_expired_size of them.
+        self.recently_expired = OrderedDict()
+        self.recently_expired_size = 64
+        self.primary_silent_ticks = 0
+        self.standby_timeout = self.time_out // 4
+        self.fallback_roots = [(Node.parse_ip(address[0]), Node.parse_port(str(address[1])))
+                               for address in (fallback_roots or [])]
         self.start_user_interface()
         if self.is_root:
             self.life = True
-            self.registered_addresses = []
-            self.graph_node = GraphNode(address=self.get_server_address())
-            self.network_graph = NetworkGraph(root=self.graph_node)
             self.root_ip = self.server_ip
             self.root_port = self.server_port
             self.state = 'joined'
+            self.journal = GraphJournal(journal_path)
+            self.journal.listeners.append(self.__replicate)
+            restored = self.journal.load(reunion_timeout=self.time_out * self.tick_interval)
+            if restored is not None and restored[0].root.address == self.get_server_address() \
+                    and restored[0].fan_out == self.fan_out:
+                self.network_graph, self.registry = restored
+                self.registry.expiry = self.time_out * self.tick_interval
+                self.graph_node = self.network_graph.root
+                self.__restore_connections()
+            else:
+                self.registry = Registry(expiry=self.time_out * self.tick_interval)
+                self.graph_node = GraphNode(address=self.get_server_address())
+                self.network_graph = NetworkGraph(root=self.graph_node,
+                                                  reunion_timeout=self.time_out * self.tick_interval,
+                                                  fan_out=self.fan_out)
+            self.journal.open(self.network_graph, self.registry)
 
         else:
             self.root_ip = Node.parse_ip(root_address[0])
             self.root_port = Node.parse_port(str(root_address[1]))
             self.client_start()
+            if self.standby:
+                self.state = 'standby'
+                self.network_graph = None
+                self.registry = None
+                self.__request_replication()
         self.run()
         pass
 
+    def __request_replication(self):
+        # As a standby, ask the root for its state.
+        self.stream.add_node(server_address=self.get_root_address(), set_register_connection=True)
+        out_packet = PacketFactory.new_replicate_packet(type='REQ', source_server_address=self.get_server_address())
+        self.stream.add_message_to_out_buff(address=self.get_root_address(), message=out_packet.get_buf())
+
+    def __replicate(self, data):
+        # GraphJournal listener of the root: every change of our state goes to the standby roots too.
+        if self.standbys:
+            buf = PacketFactory.new_replicate_packet(type='LOG', source_server_address=self.get_server_address(),
+                                                     data=data).get_buf()
+            for address in self.standbys:
+                self.stream.add_message_to_out_buff(address=address, message=buf)
+
+    def __take_over(self):
+        """
+        As a standby, become the root of the network with the replicated state: the root node of the graph gets our
+        address, every node gets a whole reunion timeout to find us, and the children of the old root are moved to
+        us. The other peers turn to us when they need the root, see fallback_roots.
+
+        :return:
+        """
+        print("The root " + str(self.get_root_address()) + " is not responding. Taking over as the root!")
+        node = self.stream.get_node_by_server(self.root_ip, self.root_port)
+        if node is not None:
+            self.stream.remove_node(node)
+        self.is_root = True
+        self.standby = False
+        self.state = 'joined'
+        self.root_ip = self.server_ip
+        self.root_port = self.server_port
+        self.root_lost_ticks = None
+        self.network_graph.set_root_address(self.get_server_address())
+        self.network_graph.restart_reunion_timers()
+        self.graph_node = self.network_graph.root
+        self.journal = GraphJournal(self.journal_path)
+        self.journal.listeners.append(self.__replicate)
+        self.journal.open(self.network_graph, self.registry)
+        self.__restore_connections()
+        for child in self.children:
+            self.__send_new_parent(child, self.get_server_address())
+
+    def __restore_connections(self):
+        """
+        After the root is restarted from its journal, or a standby took over, add the registered peers and our
+        children to the stream again; Every peer keeps its place in the network.
+        The connection to a peer is only made when we first send it something, so a root with many registered peers
+        starts running at once and never connects to the ones that are gone.
+
+        :return:
+        """
+        for address in self.registry:
+            self.stream.add_node(server_address=address, set_register_connection=True, lazy=True)
+        self.children = [child.address for child in self.network_graph.root.children]
+        print("Root state restored: " + str(len(self.registry)) + " registered peers, " +
+              str(self.network_graph.number_of_nodes) + " nodes in the network graph.")
+
     def start_user_interface(self):
         self.user_interface.start()
 
@@ -146,12 +297,14 @@ class Peer:
         """
         The main loop of the program.
 
+        The loop sleeps until a packet arrives, the user enters a command or the next timer tick is due,
+        so packets are forwarded as soon as they are received while timeouts still advance once per tick.
+
         Code design suggestions:
             1. Parse server in_buf of the stream.
             2. Handle all packets were received from our Stream server.
             3. Parse user_interface_buffer to make message packets.
             4. Send packets stored in nodes buffer of our Stream object.
-            5. ** sleep the current thread for 2 seconds **
 
         Warnings:
             1. At first check reunion daemon condition; Maybe we have a problem in this time
@@ -161,143 +314,301 @@ class Peer:
         :return:
         """
 
+        next_tick = time.monotonic() + self.tick_interval
         while self.life:
 
-            # print("@@@ Time %4 =  " + str(self.counter) +
-            #       "  /  State = " + self.state +
-            #       "  /  connection_timer = " + str(self.connection_timer) +
-            #       "  /  you_root = " + str(self.is_root) +
-            #       "  /  your_address = " + str(self.get_server_address()) +
-            #       "  /  your_parent = " + str(self.parent_address) +
-            #       "  /  your_left_child = " + str(self.left_child) +
-            #       "  /  your_address = " + str(self.right_child))
+            deadline = next_tick
+            if self.reunion_scheduler.next_send is not None:
+                deadline = min(deadline, self.reunion_scheduler.next_send)
+            self.wakeup.wait(max(0, deadline - time.monotonic()))
+            # Clear before reading the buffers so nothing that arrives meanwhile is missed.
+            self.wakeup.clear()
+
+            now = time.monotonic()
+            if now >= next_tick:
+                self.__handle_tick()
+                next_tick += self.tick_interval
+                if next_tick <= now:
+                    # We fell behind by more than one tick; don't try to catch up in a burst.
+                    next_tick = now + self.tick_interval
+
+            if self.reunion_scheduler.due(now):
+                if not self.is_root and self.state == 'joined' and self.parent_address is not None:
+                    self.send_reunion_client(retry=self.reunion_on_fly)
+                else:
+                    self.reunion_scheduler.stop()
+
+            self.__handle_in_buf()
+            self.handle_user_interface_buffer()
+            self.__send_out_buf()
 
+        pass
+
+    def __handle_tick(self):
+        """
+        Timer work that runs once per tick: reunion timeouts, the advertised reunion interval and counting up the
+        timers.
+        Root reunion timeouts come from the NetworkGraph timer wheel, so only expired nodes are visited.
 
-            ## Check reunion timeout
+        :return:
+        """
 
-            if self.is_root:
+        ## Check reunion timeout
 
+        if self.is_root:
 
-                # As Root, Remove time_out clients :
+            # As Root, Remove time_out clients :
 
-                addresses = self.network_graph.nodes.keys()
-                entries_to_remove = []
-                for key in addresses:
-                    if self.network_graph.nodes.keys().__contains__(key) \
-                            and self.network_graph.nodes[key].reunion_timer > self.time_out:
-                        # self.(node_address=self.network_graph.nodes[key].address)
-                        if key != self.get_server_address():
-                            entries_to_remove.append(key)
-                            print("Client  " + str(key) + "  was removed due to timeout . ")
-                        #TODO khaje procedure :  We decided to remove any node which it's reunion packet is timeout. Note that it's children also will be removed.
-                for entry in entries_to_remove:
-                    self.network_graph.remove_node(entry)
+            for entry in self.network_graph.pop_timed_out_nodes():
+                # The node may have gone already with the sub-tree of another timed out node.
+                if entry in self.network_graph.nodes:
+                    print("Client  " + str(entry) + "  was removed due to timeout . ")
+                    self.reparent_orphans(entry)
                     self.remove_from_neighbors(entry)
 
-            else:
+            # As Root, forget the peers that registered but never advertised :
 
-                # As Client, detect your reunion timeout
+            for address in self.registry.expire():
+                print("Registration of " + str(address) + " expired before it advertised.")
+                self.journal.unregister(address)
+                self.stream.forget_lazy_node(address)
+                node = self.stream.get_node_by_server(address[0], address[1])
+                if node is not None and address not in self.network_graph.nodes:
+                    self.__keep_expired_connection(node)
 
-                if self.connection_timer is not None and self.connection_timer > self.time_out:
-                    self.deep_disconnect()
-                    print("Timeout Detected. Sending new Advertise Request!")
-                    out_packet = PacketFactory.new_advertise_packet(type='REQ',
-                                                                    source_server_address=self.get_server_address())
-                    self.stream.add_message_to_out_buff(address=self.get_root_address(), message=out_packet.get_buf())
+        else:
 
+            # As Client, try to reach the root again for one timeout period if we have lost it
 
+            if self.root_lost_ticks is not None and not self.standby:
+                if self.__reconnect_root():
+                    print("Connection to the root was made again.")
+                elif self.root_lost_ticks > self.time_out:
+                    print("Sir we're facing a dire situation. it seems the HQ is taken down and we've lost the war")
+                    exit(0)
+                else:
+                    self.root_lost_ticks += 1
 
-            ## Handle received packets and send buffered packets each 2 seconds :
+            # As Client, detect your reunion timeout
 
-            if self.counter == 2 or self.counter == 0:
+            if self.connection_timer is not None and self.connection_timer > self.time_out:
+                self.deep_disconnect()
+                print("Timeout Detected. Sending new Advertise Request!")
+                out_packet = PacketFactory.new_advertise_packet(type='REQ',
+                                                                source_server_address=self.get_server_address())
+                self.stream.add_message_to_out_buff(address=self.get_root_address(), message=out_packet.get_buf())
 
-                buffs = self.stream.read_in_buf()
-                packs = []
+        ## Reunion Hellos are sent by run when reunion_scheduler says so; As root, adjust the advertised interval:
 
-                for i in range(len(buffs)):
-                    packs.append(PacketFactory.parse_buffer(buffs[i]))
+        if self.is_root:
+            self.__adjust_reunion_interval()
 
-                for i in range(len(buffs)):
-                    self.handle_packet(packs[i])
+        if self.is_root and self.ticks % self.rebalance_interval == 0:
+            self.run_reunion_daemon()
 
-                if not self.is_root and self.state == 'joined' and self.connection_timer >= 0 and not self.reunion_on_fly:
-                    self.send_reunion_client()
-                    # print(" New reunion_packet sent")
+        if self.journal is not None and self.journal.should_snapshot():
+            self.journal.snapshot(self.network_graph, self.registry)
 
-                self.stream.clear_in_buff()
-                problematic_nodes = self.stream.send_out_buf_messages()
-                for node in problematic_nodes:
-                    if not node.is_root and node.get_server_address() != self.get_root_address():
-                        print("Removing problematic node: " + str(node.get_server_address()))
-                        if self.is_root:
-                            self.network_graph.remove_node(node.get_server_address())
-                        self.stream.remove_node(node)
-                        if self.left_child == node.get_server_address():
-                            self.left_child = None
-                        elif self.right_child == node.get_server_address():
-                            self.right_child = None
-                        elif self.parent_address == node.get_server_address():
-                            self.deep_disconnect()
-                            print("Disconnection Detected. Sending new Advertise Request!")
-                            out_packet = PacketFactory.new_advertise_packet(type='REQ', source_server_address=self.get_server_address())
-                            self.stream.add_message_to_out_buff(self.get_root_address(), out_packet.get_buf())
+        if self.is_root and self.standbys:
+            beat = PacketFactory.new_replicate_packet(type='BET', source_server_address=self.get_server_address())
+            for address in self.standbys:
+                self.stream.add_message_to_out_buff(address=address, message=beat.get_buf())
 
-                    else:
-                        print("Sir we're facing a dire situation. it seems the HQ is taken down and we've lost the war")
-                        exit(0)
-                self.handle_user_interface_buffer()
+        if self.standby:
+            self.primary_silent_ticks += 1
+            if self.primary_silent_ticks >= self.standby_timeout:
+                if self.network_graph is not None:
+                    self.__take_over()
+                else:
+                    # The root never answered; ask again.
+                    self.primary_silent_ticks = 0
+                    self.__request_replication()
+
+        ## Count Up everything for loop
 
+        self.ticks += 1
 
-            ## Count Up everything for loop
+        if self.connection_timer is not None:
+            self.connection_timer += 1
 
-            self.counter += 1
-            if self.counter == 4:
-                self.counter = 0
+    def __handle_in_buf(self):
+        """
+        Parse and handle every packet our Stream server has received.
 
-            if self.connection_timer is not None:
-                self.connection_timer += 1
+        :return:
+        """
 
-            if self.is_root:
-                for kk in self.network_graph.nodes.keys():
-                    self.network_graph.nodes[kk].reunion_timer += 1
+        buffs = self.stream.read_in_buf()
+        packs = []
 
-            time.sleep(1)
+        for i in range(len(buffs)):
+            packs.append(PacketFactory.parse_buffer(buffs[i]))
 
-        pass
+        for i in range(len(packs)):
+            self.handle_packet(packs[i])
+
+    def __send_out_buf(self):
+        """
+        Send the buffered packets of every node and deal with the nodes that turned out to be unreachable.
+
+        :return:
+        """
+
+        problematic_nodes = self.stream.send_out_buf_messages()
+        for node in problematic_nodes:
+            if not node.is_root and node.get_server_address() != self.get_root_address():
+                print("Removing problematic node: " + str(node.get_server_address()))
+                if self.is_root:
+                    if node.get_server_address() in self.standbys:
+                        self.standbys.remove(node.get_server_address())
+                    else:
+                        self.reparent_orphans(node.get_server_address())
+                self.stream.remove_node(node)
+                if node.get_server_address() in self.children:
+                    self.__remove_child(node.get_server_address())
+                elif self.parent_address == node.get_server_address():
+                    # Keep our children: the root will move us to a new parent. If it doesn't, the reunion timeout
+                    # falls back to a new Advertise Request.
+                    self.parent_address = None
+                    self.reunion_on_fly = False
+                    self.reunion_scheduler.stop()
+                    print("Disconnection Detected. Waiting for the root to assign a new parent!")
+
+            elif not self.is_root:
+                if node in self.stream.nodes:
+                    self.stream.remove_node(node)
+                if self.__reconnect_root():
+                    print("Connection to the root was lost and made again.")
+                elif self.root_lost_ticks is None:
+                    self.root_lost_ticks = 0
+                    print("Connection to the root was lost. Trying to reconnect!")
+
+            else:
+                print("Sir we're facing a dire situation. it seems the HQ is taken down and we've lost the war")
+                exit(0)
+
+    def __reconnect_root(self):
+        """
+        Make a new connection to the root after the old one broke; The root may have been restarted from its journal.
+        If it has been lost for standby_timeout ticks, the fallback roots are tried too, as a standby may have taken
+        over by then.
+
+        :return: Whether we are connected to a root again.
+        :rtype: bool
+        """
+        candidates = [self.get_root_address()]
+        if self.root_lost_ticks is not None and self.root_lost_ticks >= self.standby_timeout:
+            candidates += [address for address in self.fallback_roots if address != self.get_root_address()]
+        for address in candidates:
+            self.stream.add_node(server_address=address, set_register_connection=True)
+            if self.stream.get_node_by_server(address[0], address[1]) is not None:
+                self.__adopt_root(address)
+                self.root_lost_ticks = None
+                return True
+        return False
+
+    def __adopt_root(self, address):
+        # Make one of our fallback roots our root.
+        if address != self.get_root_address():
+            print("Root changed from " + str(self.get_root_address()) + " to " + str(address) + " .")
+            if self.get_root_address() not in self.fallback_roots:
+                self.fallback_roots.append(self.get_root_address())
+            self.root_ip, self.root_port = address
 
     def run_reunion_daemon(self):
         """
+        The root's rebalancing daemon; It runs every rebalance_interval ticks.
 
-        In this function, we will handle all Reunion actions.
+        Reunion timeouts and Reunion Hellos are handled in every tick (see __handle_tick). After some churn the tree
+        may get lopsided though, with leaves far deeper than they have to be, which makes broadcasts and reunions
+        slower for them. So here we move up to rebalance_moves of the deepest nodes to free slots nearer to the root
+        (see NetworkGraph.rebalance_step); Only a few nodes are moved at a time, as each of them has to reconnect.
 
-        Code design suggestions:
-            1. Check if we are the network root or not; The actions are identical.
-            2. If it's the root Peer, in every interval check the latest Reunion packet arrival time from every node;
-               If time is over for the node turn it off (Maybe you need to remove it from our NetworkGraph).
-            3. If it's a non-root peer split the actions by considering whether we are waiting for Reunion Hello Back
-               Packet or it's the time to send new Reunion Hello packet.
+        :return: The balance of the tree after the moves, see NetworkGraph.balance_metrics.
+        :rtype: dict
+        """
+        if not self.is_root:
+            return None
+        for _ in range(self.rebalance_moves):
+            move = self.network_graph.rebalance_step()
+            if move is None:
+                break
+            self.__send_new_parent(move[0], move[1])
+            print("Rebalancing: client " + str(move[0]) + " is moved to " + str(move[1]) + " . " +
+                  str(self.network_graph.balance_metrics()))
+        return self.network_graph.balance_metrics()
+
+    def reparent_orphans(self, node_address):
+        """
+        As the root, remove a failed node from our NetworkGraph but keep its sub-tree: each of its children is moved
+        with its own sub-tree to a new parent, and gets an Advertise Response with that parent through its
+        register_connection, so only the children have to reconnect.
 
-        Warnings:
-            1. If we are the root of the network in the situation that we want to turn a node off, make sure that you will not
-               advertise the nodes sub-tree in our GraphNode.
-            2. If we are a non-root Peer, save the time when you have sent your last Reunion Hello packet; You need this
-               time for checking whether the Reunion was failed or not.
-            3. For choosing time intervals you should wait until Reunion Hello or Reunion Hello Back arrival,
-               pay attention that our NetworkGraph depth will not be bigger than 8. (Do not forget main loop sleep time)
-            4. Suppose that you are a non-root Peer and Reunion was failed, In this time you should make a new Advertise
-               Request packet and send it through your register_connection to the root; Don't forget to send this packet
-               here, because in the Reunion Failure mode our main loop will not work properly and everything will be got stock!
+        :param node_address: Address of the failed node.
+        :type node_address: tuple
+
+        :return: (child address, new parent address) for every moved child.
+        :rtype: list
+        """
+        moves = self.network_graph.remove_and_reparent(node_address)
+        for child, new_parent in moves:
+            self.__send_new_parent(child, new_parent)
+            print("Client " + str(child) + " lost its parent " + str(node_address) + " and is moved to " +
+                  str(new_parent) + ".")
+        return moves
+
+    def __send_new_parent(self, node_address, new_parent):
+        # An Advertise Response to a joined node moves it to 'new_parent'; it goes through its register_connection.
+        out_packet = PacketFactory.new_advertise_packet(type='RES', source_server_address=self.get_server_address(),
+                                                        neighbour=new_parent)
+        self.stream.add_message_to_out_buff(address=node_address, message=out_packet.get_buf())
+
+    def __adjust_reunion_interval(self):
+        """
+        As the root, keep the rate of arriving Reunion Hellos near reunion_target_rate as the network grows or
+        shrinks: the advertised interval is scaled by the ratio of the measured rate to the target, a little every
+        tick, so it settles instead of swinging with the noise of single ticks.
 
         :return:
         """
-        pass
+        self.reunion_rate += (self.reunion_arrivals / self.tick_interval - self.reunion_rate) / 8
+        self.reunion_arrivals = 0
+        if self.reunion_target_rate is None:
+            return
+        ratio = min(2.0, max(0.5, self.reunion_rate / self.reunion_target_rate))
+        interval = self.reunion_interval * ratio ** 0.25
+        self.reunion_interval = min(max(interval, self.reunion_scheduler.min_interval),
+                                    self.reunion_scheduler.max_interval)
+
+    def send_reunion_client(self, retry=False):
+        """
+        Send a Reunion Hello to our parent.
+
+        In aggregated reunion mode, or when some of our children sent us Summaries, a Summary is sent instead: us and
+        the peers that reported to us since the last one. The parent answers it right away, and the reunion timer
+        comes from its answer instead of being restarted here.
 
-    def send_reunion_client(self):
+        :param retry: Whether this repeats an unanswered Hello; A retry doesn't restart the reunion timeout.
+        :type retry: bool
+
+        :return:
+        """
 
-        self.connection_timer = 0
         self.reunion_on_fly = True
+        self.reunion_sent_at = time.monotonic()
+        self.reunion_scheduler.on_sent(self.reunion_sent_at)
+        if self.aggregate_reunion or self.reunion_entries:
+            entries = [(self.get_server_address(), self.reunion_hop_rtt)]
+            entries.extend(self.reunion_entries.items())
+            self.reunion_entries = {}
+            ms = PacketFactory.new_reunion_summary_packet(source_address=self.get_server_address(), entries=entries)
+            self.stream.add_message_to_out_buff(address=self.parent_address, message=ms.get_buf())
+            print("Sent Reunion Summary of " + str(len(entries)) + " peers to Parent: " + str(self.parent_address))
+            return
+        if not retry:
+            self.connection_timer = 0
         ms = PacketFactory.new_reunion_packet(type='REQ', source_address=self.get_server_address(),
-                                              nodes_array=[self.get_server_address()])
+                                              nodes_array=[self.get_server_address()], rtt=self.reunion_rtt)
         self.stream.add_message_to_out_buff(address=self.parent_address, message=ms.get_buf())
         print("Sent Reunion Packet to Parent: " + str(self.parent_address))
 
@@ -311,24 +622,23 @@ class Peer:
             1. Don't send Message packets through register_connections.
 
         :param broadcast_packet: The packet that should be broadcast through the network.
-        :type broadcast_packet: Packet
+        :type broadcast_packet: Packet or PacketView
         :param except_address: The address from which this message has come
         :type except_address: tuple
 
         :return:
         """
-        print("Sending Broadcast Message: " + broadcast_packet.get_body())
+        # The body is not decoded here; forwarding a message must not depend on its size.
+        print("Sending Broadcast Message of " + str(broadcast_packet.get_length()) + " bytes.")
+        # Every neighbour gets the very same buffer.
+        buf = broadcast_packet.get_buf()
         if self.parent_address is not None and self.parent_address != except_address:
-            self.stream.add_message_to_out_buff(address=self.parent_address, message=broadcast_packet.get_buf())
+            self.stream.add_message_to_out_buff(address=self.parent_address, message=buf)
             # print("Message packet recieved from "+broadcast_source+"  .  Broadcasted to parent : "+self.parent_address)
 
-        if self.left_child is not None and self.left_child != except_address:
-            self.stream.add_message_to_out_buff(address=self.left_child, message=broadcast_packet.get_buf())
-            # print("Message packet recieved from "+broadcast_source+"  .  Broadcasted to left child : "+self.left_child)
-
-        if self.right_child is not None and self.right_child != except_address:
-            self.stream.add_message_to_out_buff(address=self.right_child, message=broadcast_packet.get_buf())
-            # print("Message packet recieved from "+broadcast_source+"  .  Broadcasted to right child : "+self.right_child)
+        for child in self.children:
+            if child != except_address:
+                self.stream.add_message_to_out_buff(address=child, message=buf)
 
         pass
 
@@ -342,8 +652,7 @@ class Peer:
         :return:
         """
 
-        # FIXME in tabe daghighan chie
-        if source_address not in self.registered_addresses:
+        if source_address not in self.registry:
             print("Unregistered message received from: " + str(source_address))
             return False
         return True
@@ -359,29 +668,78 @@ class Peer:
 
         :param packet: The arrived packet that should be handled.
 
-        :type packet Packet
+        :type packet PacketView
 
         """
 
         ########packet validation :
 
-        if packet.type == 1:
+        packet_type = packet.get_type()
+
+        if packet_type == 6:
+            self.__handle_replicate_packet(packet)
+            return
+
+        if self.state == 'standby':
+            print("Packets other than Replicate are dropped while we are a standby root.")
+            return
+
+        if packet_type == 1:
             self.__handle_register_packet(packet)
 
-        if packet.type == 2:
+        if packet_type == 2:
             self.__handle_advertise_packet(packet)
 
-        if packet.type == 3:
+        if packet_type == 3:
             self.__handle_join_packet(packet)
 
-        if packet.type == 4:
+        if packet_type == 4:
             self.__handle_message_packet(packet)
 
-        if packet.type == 5:
+        if packet_type == 5:
             self.__handle_reunion_packet(packet)
 
         pass
 
+    def __handle_replicate_packet(self, packet):
+        """
+        Replication of the root's state to its standby roots.
+
+        As the root, a Replicate Request makes the sender one of our standbys: it gets a snapshot of our state now,
+        and every change after it (see __replicate).
+        As a standby, the packets from the root keep our copy of its state up to date and tell us the root is alive.
+
+        :param packet: Arrived replicate packet.
+        :type packet: PacketView
+
+        :return:
+        """
+        kind = packet.get_body_kind()
+        if self.is_root and kind == 'REQ':
+            standby = packet.get_source_server_address()
+            self.stream.add_node(server_address=standby, set_register_connection=True)
+            if standby not in self.standbys:
+                self.standbys.append(standby)
+            state = GraphJournal.encode_state(self.network_graph, self.registry)
+            out_packet = PacketFactory.new_replicate_packet(type='SNP', source_server_address=self.get_server_address(),
+                                                            data=state)
+            self.stream.add_message_to_out_buff(address=standby, message=out_packet.get_buf())
+            print("Standby root " + str(standby) + " is added and a snapshot of " + str(len(state)) +
+                  " bytes is sent to it.")
+
+        elif self.standby and packet.get_source_server_address() == self.get_root_address():
+            self.primary_silent_ticks = 0
+            if kind == 'SNP':
+                self.network_graph, self.registry, _ = GraphJournal.decode_state(
+                    packet.get_body_bytes()[3:], reunion_timeout=self.time_out * self.tick_interval)
+                self.registry.expiry = self.time_out * self.tick_interval
+                print("Snapshot of the root received: " + str(self.network_graph.number_of_nodes) + " nodes.")
+            elif kind == 'LOG' and self.network_graph is not None:
+                GraphJournal.apply(self.network_graph, self.registry, packet.get_body_bytes()[3:])
+
+        else:
+            print("Invalid Replicate packet received!")
+
     def __handle_register_packet(self, packet):
         """
         For registration a new node to the network at first we should make a Node with stream.add_node for'sender' and
@@ -394,24 +752,28 @@ class Peer:
             1. Don't forget to ignore Register Request packets when you are a non-root peer.
 
         :param packet: Arrived register packet
-        :type packet Packet
+        :type packet PacketView
         :return:
         """
 
 
         if self.is_root:
 
-            if packet.get_body()[0:3] == 'REQ':
+            if packet.get_body_kind() == 'REQ':
 
                 ack = not self.__check_registered(packet.get_source_server_address())
                 if ack:
+                    self.recently_expired.pop(Node.pack_address(packet.get_source_server_address()), None)
                     self.stream.add_node(server_address=packet.get_source_server_address(),
                                          set_register_connection=True)
                     out_packet = PacketFactory.new_register_packet(type='RES',
-                                                                   source_server_address=self.get_server_address())
+                                                                   source_server_address=self.get_server_address(),
+                                                                   fan_out=self.fan_out)
                     self.stream.add_message_to_out_buff(address=packet.get_source_server_address(),
                                                         message=out_packet.get_buf())
-                    self.registered_addresses.append(packet.get_source_server_address())
+                    self.registry.add(packet.get_source_server_address())
+                    if self.journal is not None:
+                        self.journal.register(packet.get_source_server_address())
 
                     print("register,REQ  packet from client : " + str(packet.get_source_server_address()) + "  ACK: " +
                           str(ack) + "  RESPONDED succesfully")
@@ -424,9 +786,21 @@ class Peer:
 
         else:
 
-            if packet.get_body()[0:3] == 'RES' and self.state == 'newborn':
+            if packet.get_body_kind() == 'RES' and packet.get_body()[3:6] == 'NAK':
+
+                # Our registration expired at the root before we advertised.
+                if self.state == 'registered':
+                    self.state = 'newborn'
+                    print(" register,RES packet from root . We are not registered anymore; Register again.")
+
+            elif packet.get_body_kind() == 'RES' and self.state == 'newborn':
 
                 self.state = 'registered'
+                fan_out = PacketFactory.parse_register_fan_out(packet.get_body())
+                if fan_out is not None and fan_out != self.fan_out:
+                    print("Fan-out of the network is " + str(fan_out) + "; using it instead of " +
+                          str(self.fan_out) + ".")
+                    self.fan_out = fan_out
                 # out_packet = PacketFactory.new_advertise_packet(type='REQ',
                 #                                                 source_server_address=self.get_server_adress())
                 # self.stream.add_message_to_out_buff(address=self.get_root_address(), message=out_packet.get_buf())
@@ -436,6 +810,46 @@ class Peer:
             else:
                 print("Invalid register packer received!")
 
+    def __keep_expired_connection(self, node):
+        """
+        As the root, keep the register connection of a peer whose registration expired, so __refuse_unregistered can
+        answer it; The oldest one kept is closed when there are more than recently_expired_size of them.
+
+        :param node: Register connection of the peer.
+        :type node: Node
+
+        :return:
+        """
+        self.recently_expired.pop(node.packed_address, None)
+        self.recently_expired[node.packed_address] = node
+        if len(self.recently_expired) <= self.recently_expired_size:
+            return
+        _, oldest = self.recently_expired.popitem(last=False)
+        address = oldest.get_server_address()
+        if self.stream.get_node_by_server(address[0], address[1]) is oldest and address not in self.registry \
+                and address not in self.network_graph.nodes:
+            self.stream.remove_node(oldest)
+
+    def __refuse_unregistered(self, address):
+        """
+        As the root, tell a peer that it is not registered, with a Register Response NAK.
+        The answer only goes through a connection we have, e.g. one kept by __keep_expired_connection; Connecting to
+        an address taken from a packet header would let anyone keep the root busy, so the packet is dropped instead.
+
+        :param address: Address of the peer.
+        :type address: tuple
+
+        :return:
+        """
+        node = self.stream.get_node_by_server(address[0], address[1])
+        if node is None:
+            print("No connection to " + str(address) + "; Its packet is dropped.")
+            return
+        out_packet = PacketFactory.new_register_packet(type='RES', source_server_address=self.get_server_address(),
+                                                       ack=False)
+        node.add_message_to_out_buff(out_packet.get_buf())
+        print(str(address) + " is asked to register again.")
+
     def __handle_advertise_packet(self, packet):
         """
         For advertising peers in the network, It is peer discovery message.
@@ -461,18 +875,20 @@ class Peer:
 
         :param packet: Arrived register packet
 
-        :type packet Packet
+        :type packet PacketView
 
         :return:
         """
 
         if self.is_root :
 
-            if packet.get_body()[0:3] == 'REQ' :
+            if packet.get_body_kind() == 'REQ' :
 
                 if not self.__check_registered(packet.get_source_server_address()):
-                    print("Unregistered Advertise Packet Received!")
+                    print("Unregistered Advertise Packet Received! " + str(packet.get_source_server_address()))
+                    self.__refuse_unregistered(packet.get_source_server_address())
                     return
+                self.registry.confirm(packet.get_source_server_address())
 
                 # IT SEEMS WE HAVE TO RESET THE NODE EVERY TIME A DUPLICATE ADVERTISE IS RECEIVED
 
@@ -509,7 +925,7 @@ class Peer:
 
         else:
 
-            if packet.get_body()[0:3] == 'RES' and self.state == 'registered':
+            if packet.get_body_kind() == 'RES' and self.state == 'registered':
 
                 self.state = 'advertised'
                 self.stream.add_node(server_address=(packet.get_body()[3:18], packet.get_body()[18:23]),
@@ -520,9 +936,42 @@ class Peer:
                 self.parent_address = (packet.get_body()[3:18], packet.get_body()[18:23])
                 self.state = 'joined'
                 self.connection_timer = -4
+                self.reunion_scheduler.start()
                 print("Advertise packet RES from root , recieved . Client " + str(self.parent_address) +
                       " is chosen as your parent. state changed to joined and Join packet sent to parent.")
 
+            elif packet.get_body_kind() == 'RES' and self.state == 'joined':
+
+                # The root moved us (and our sub-tree) to a new parent, because the old one failed or to rebalance
+                # the tree; If the old parent is still there, tell it to free our place before we leave.
+                # A standby root that has taken over moves the children of the old root to itself.
+                if packet.get_source_server_address() in self.fallback_roots:
+                    self.__adopt_root(packet.get_source_server_address())
+                new_parent = (packet.get_body()[3:18], packet.get_body()[18:23])
+                if self.parent_address is not None and self.parent_address != new_parent:
+                    node = self.stream.get_node_by_server(self.parent_address[0], self.parent_address[1])
+                    if node is not None:
+                        out_packet = PacketFactory.new_join_packet(source_server_address=self.get_server_address(),
+                                                                   leave=True)
+                        node.add_message_to_out_buff(out_packet.get_buf())
+                        try:
+                            self.stream.send_messages_to_node(node)
+                        except ConnectionResetError:
+                            # The old parent is gone already.
+                            pass
+                        # The connection to the root is our register_connection too.
+                        if node in self.stream.nodes and self.parent_address != self.get_root_address():
+                            self.stream.remove_node(node)
+                self.stream.add_node(server_address=new_parent, set_register_connection=False)
+                out_packet = PacketFactory.new_join_packet(source_server_address=self.get_server_address())
+                self.stream.add_message_to_out_buff(address=new_parent, message=out_packet.get_buf())
+                self.parent_address = new_parent
+                self.connection_timer = -4
+                self.reunion_on_fly = False
+                self.reunion_scheduler.start()
+                print("Advertise packet RES from root , recieved . You are moved to new parent " +
+                      str(self.parent_address) + " with your sub-tree and Join packet sent to it.")
+
             else:
                 print("Invalid Advertise Packet Received!!!")
 
@@ -534,39 +983,49 @@ class Peer:
         :param packet: Arrived register packet.
 
 
-        :type packet Packet
+        :type packet PacketView
 
         :return:
         """
 
-        if self.left_child is None:
-            self.stream.add_node(server_address=packet.get_source_server_address(), set_register_connection=False)
-            self.left_child = packet.get_source_server_address()
-            print("Client  " + str(packet.get_source_server_address()) + "  is joined as your left child .")
-        elif self.right_child is None:
+        if packet.get_body()[0:4] == 'QUIT':
+            if packet.get_source_server_address() in self.children:
+                self.__remove_child(packet.get_source_server_address())
+                node = self.stream.get_node_by_server(packet.get_source_server_ip(), packet.get_source_server_port())
+                # The root keeps the register_connection of the node.
+                if node is not None and not self.is_root:
+                    self.stream.remove_node(node)
+                print("Client  " + str(packet.get_source_server_address()) + "  has left you for another parent .")
+            return
+
+        if packet.get_source_server_address() in self.children:
+            print("Client  " + str(packet.get_source_server_address()) + "  is already your child .")
+        elif len(self.children) < self.fan_out:
             self.stream.add_node(server_address=packet.get_source_server_address(), set_register_connection=False)
-            self.right_child = packet.get_source_server_address()
-            print("Client  " + str(packet.get_source_server_address()) + "  is joined as your right child .")
+            self.children.append(packet.get_source_server_address())
+            print("Client  " + str(packet.get_source_server_address()) + "  is joined as your child number " +
+                  str(len(self.children)) + " .")
         else:
-            print("You have 2 joined children but client " + str(packet.get_source_server_address()) +
-                  "  wants to join you!!!.")
+            print("You have " + str(self.fan_out) + " joined children but client " +
+                  str(packet.get_source_server_address()) + "  wants to join you!!!.")
 
     def __handle_reunion_packet(self, packet):
         """
         In this function we should handle Reunion packet was just arrived.
 
         Reunion Hello:
-            If you are root Peer you should answer with a new Reunion Hello Back packet.
-            At first extract all addresses in the packet body and append them in descending order to the new packet.
-            You should send the new packet to the first address in the arrived packet.
-            If you are a non-root Peer append your IP/Port address to the end of the packet and send it to your parent.
+            If you are root Peer you should answer with a new Reunion Hello Back packet for the first address in the
+            arrived packet, and send it to the sender.
+            If you are a non-root Peer remember which child the Hello of that address came from in reunion_routes, and
+            relay the packet to your parent.
 
         Reunion Hello Back:
-            Check that you are the end node or not; If not only remove your IP/Port address and send the packet to the next
-            address, otherwise you received your response from the root and everything is fine.
+            Check that you are the end node or not; If not relay the packet to the child that reunion_routes has for
+            its target and forget that route, otherwise you received your response from the root and everything is
+            fine.
 
         Warnings:
-            1. Every time adding or removing an address from packet don't forget to update Entity Number field.
+            1. Relayed packets are not decoded again; only their source address is changed.
             2. If you are the root, update last Reunion Hello arrival packet from the sender node and turn it on.
             3. If you are the end node, update your Reunion mode from pending to acceptance.
 
@@ -598,40 +1057,87 @@ class Peer:
                           "  .   Source_address node in network_graph is turned_off.")
                     return
 
-                node_list = []
-                for i in range(int(body[3:5])):
-                    node_list.append((body[5 + 20 * i:20 + 20 * i], body[20 + 20 * i:25 + 20 * i]))
-                node_list.reverse()
-                self.network_graph.nodes[node_list[len(node_list) - 1]].reunion_timer = 0
+                origin = (body[5:20], body[20:25])
+                # A late Hello of a node that has been removed already is not answered, so it advertises again.
+                if origin not in self.network_graph.nodes or not self.network_graph.nodes[origin].alive:
+                    print("Reunion,REQ packet of removed client : " + str(origin) + "  dropped.")
+                    return
+                self.network_graph.reset_reunion_timer(origin)
+                rtt = PacketFactory.parse_reunion_rtt(body)
+                if rtt is not None:
+                    self.network_graph.report_rtt(origin, rtt)
+                # The peers on the way know the route back to the origin.
+                self.reunion_arrivals += 1
                 ms = PacketFactory.new_reunion_packet(source_address=self.get_root_address(), type='RES',
-                                                      nodes_array=node_list).get_buf()
+                                                      nodes_array=[origin], interval=self.reunion_interval).get_buf()
                 self.stream.add_message_to_out_buff(address=packet.get_source_server_address(), message=ms)
-                print("Reunion,REQ packet from client : " + str(node_list[len(node_list) - 1]) +
-                      "  .  Node.reunion_timer in network_graph reseted to 0 successfully and RES reunion sent to client.")
-
+                print("Reunion,REQ packet from client : " + str(origin) +
+                      "  .  Node reunion timer in network_graph restarted successfully and RES reunion sent to client.")
+
+
+            elif body[0:3] == 'AGG':
+
+                # Every peer on the way holds the reports of its sub-tree for up to one jittered interval, so deep
+                # peers get more time before they time out.
+                self.network_graph.reunion_level_delay = \
+                    self.reunion_interval * (1 + self.reunion_scheduler.jitter / 2)
+                self.reunion_arrivals += 1
+                reported = 0
+                for address, rtt in PacketFactory.parse_reunion_summary(body):
+                    # The same checks as for a Hello, for every peer of the Summary.
+                    if address in self.network_graph.nodes and self.network_graph.nodes[address].alive:
+                        self.network_graph.reset_reunion_timer(address)
+                        if rtt is not None:
+                            self.network_graph.report_hop_rtt(address, rtt)
+                        reported += 1
+                ms = PacketFactory.new_reunion_ack_packet(source_address=self.get_server_address(), age=-4).get_buf()
+                self.stream.add_message_to_out_buff(address=packet.get_source_server_address(), message=ms)
+                print("Reunion Summary from client : " + str(packet.get_source_server_address()) + "  .  " +
+                      str(reported) + " node reunion timers in network_graph restarted.")
 
             else:
                 print("Invalid Reunion Packet recieved!!!")
 
         else:
 
-            if body[0:3] == 'REQ':
+            if body[0:3] == 'AGG':
 
                 if not self.state == 'joined':
-
-                    print("Reunion,REQ packet received from client : " + str(packet.get_source_server_address()) +
+                    print("Reunion Summary received from client : " + str(packet.get_source_server_address()) +
                           " .  But you are not joined thus reunion packet is dropped.")
                     return
 
-                node_list = []
-                for i in range(int(body[3:5])):
-                    node_list.append((body[5 + 20 * i:20 + 20 * i], body[20 + 20 * i:25 + 20 * i]))
+                # Kept for our next Summary; A peer that reported twice in the meantime is sent once.
+                self.reunion_entries.update(PacketFactory.parse_reunion_summary(body))
+                ms = PacketFactory.new_reunion_ack_packet(source_address=self.get_server_address(),
+                                                          age=self.connection_timer).get_buf()
+                self.stream.add_message_to_out_buff(address=packet.get_source_server_address(), message=ms)
+
+            elif body[0:3] == 'ACK':
+
+                if not self.state == 'joined' or packet.get_source_server_address() != self.parent_address:
+                    print("Reunion Summary Back from " + str(packet.get_source_server_address()) + " dropped.")
+                    return
+
+                if self.reunion_on_fly and self.reunion_sent_at is not None:
+                    self.reunion_hop_rtt = time.monotonic() - self.reunion_sent_at
+                # Our path to the root is as fresh as our parent's.
+                self.connection_timer = int(body[3:7])
+                self.reunion_on_fly = False
+                self.reunion_scheduler.on_answered()
 
-                node_list.append(self.get_server_address())
+            elif body[0:3] == 'REQ':
+
+                if not self.state == 'joined':
 
-                ms = PacketFactory.new_reunion_packet(source_address=self.get_server_address(), type='REQ',
-                                                      nodes_array=node_list).get_buf()
-                self.stream.add_message_to_out_buff(address=self.parent_address, message=ms)
+                    print("Reunion,REQ packet received from client : " + str(packet.get_source_server_address()) +
+                          " .  But you are not joined thus reunion packet is dropped.")
+                    return
+
+                # The Hello Back to the origin will take the same way back.
+                self.reunion_routes[(body[5:20], body[20:25])] = packet.get_source_server_address()
+                packet.set_source_server_address(self.get_server_address())
+                self.stream.add_message_to_out_buff(address=self.parent_address, message=packet.get_buf())
                 print("Reunion REQ packet received from client : " + str(packet.get_source_server_address()) +
                       "  and successfully directed to parent :  " + str(self.parent_address))
 
@@ -644,34 +1150,29 @@ class Peer:
                           " .  But you are not joined thus reunion packet is dropped .")
                     return
 
-                if int(body[3:5]) == 1:
-                    if body[5:20] == self.server_ip and body[20:25] == self.server_port:
-                        self.connection_timer = -4
-                        self.reunion_on_fly = False
-                        print("Reunion RES packet recieved from yourself recieved to yourself and connection_timer reset" +
-                              " to -4 . ")
-                    else:
-                        print("Invalid Reunion Hello packet received. there must be a problem in packet forwarding.")
+                # The target is the last entry.
+                offset = 5 + 20 * (int(body[3:5]) - 1)
+                target = (body[offset:offset + 15], body[offset + 15:offset + 20])
+                if target == self.get_server_address():
+                    if self.reunion_on_fly and self.reunion_sent_at is not None:
+                        self.reunion_rtt = time.monotonic() - self.reunion_sent_at
+                    self.connection_timer = -4
+                    self.reunion_on_fly = False
+                    interval = PacketFactory.parse_reunion_interval(body)
+                    if interval is not None:
+                        self.reunion_scheduler.set_interval(interval)
+                    self.reunion_scheduler.on_answered()
+                    print("Reunion RES packet recieved from yourself recieved to yourself and connection_timer reset" +
+                          " to -4 . ")
 
                 else:
-                    node_list = []
-                    for i in range(1, int(body[3:5])):
-                        node_list.append((body[5 + 20 * i:20 + 20 * i], body[20 + 20 * i:25 + 20 * i]))
-
-                    ms = PacketFactory.new_reunion_packet(source_address=self.get_server_address(),
-                                                          type='RES', nodes_array=node_list).get_buf()
-
-                    if self.left_child is not None and body[25:40] == self.left_child[0] and body[40:45] == \
-                            self.left_child[1]:
-                        self.stream.add_message_to_out_buff(address=self.left_child, message=ms)
-                        print("Reunion RES packet received from client : " + str(packet.get_source_server_address()) +
-                              "  . mirrored to left child successfully.")
-
-                    elif self.right_child is not None and body[25:40] == self.right_child[0] and body[40:45] == \
-                            self.right_child[1]:
-                        self.stream.add_message_to_out_buff(address=self.right_child, message=ms)
+                    # A route is used once; The next Hello of the target sets it again, along its path of then.
+                    next_hop = self.reunion_routes.pop(target, None)
+                    if next_hop in self.children:
+                        packet.set_source_server_address(self.get_server_address())
+                        self.stream.add_message_to_out_buff(address=next_hop, message=packet.get_buf())
                         print("Reunion RES packet received from client : " + str(packet.get_source_server_address()) +
-                              "  . mirrored to right child successfully.")
+                              "  . mirrored to child " + str(next_hop) + " successfully.")
 
                     else:
                         print("Reunion RES packet recieved from client : " + str(packet.get_source_server_address()) +
@@ -687,7 +1188,7 @@ class Peer:
 
         :param packet: Arrived message packet
 
-        :type packet: Packet
+        :type packet: PacketView
 
         :return:
         """
@@ -696,36 +1197,10 @@ class Peer:
             print("Message packet from stranger . dropped !!!")
             return
 
-        out_packet = PacketFactory.new_message_packet(message=packet.get_body(),
-                                                      source_server_address=self.get_server_address())
-        self.send_broadcast_packet(out_packet, packet.get_source_server_address())
-        # broadcast_source = "@@@"
-        # if packet.get_source_server_address() == self.parent_address:
-        #     broadcast_source = "parent"
-        # if packet.get_source_server_address() == self.left_child:
-        #     broadcast_source = "left child"
-        # if packet.get_source_server_address() == self.right_child:
-        #     broadcast_source = "right child"
-        #
-        # if self.parent_address is not None and not (
-        #                 self.parent_address[0] == packet.get_source_server_address()[0] and self.parent_address[1] ==
-        #             packet.get_source_server_address()[1]):
-        #     self.stream.add_message_to_out_buff(address=self.parent_address, message=out_packet.get_buf())
-        #     print(
-        #             "Message packet recieved from " + broadcast_source + "  .  Broadcasted to parent : " + self.parent_address)
-        # if self.left_child is not None and not (
-        #                 self.left_child[0] == packet.get_source_server_address()[0] and self.left_child[1] ==
-        #             packet.get_source_server_address()[1]):
-        #     self.stream.add_message_to_out_buff(address=self.left_child, message=out_packet.get_buf())
-        #     print(
-        #             "Message packet recieved from " + broadcast_source + "  .  Broadcasted to left child : " + self.left_child)
-        #
-        # if self.right_child is not None and not (
-        #                 self.right_child[0] == packet.get_source_server_address()[0] and self.right_child[1] ==
-        #             packet.get_source_server_address()[1]):
-        #     self.stream.add_message_to_out_buff(address=self.right_child, message=out_packet.get_buf())
-        #     print(
-        #             "Message packet recieved from " + broadcast_source + "  .  Broadcasted to right child : " + self.right_child)
+        # Relay the received buffer itself; only its source address is patched to ours.
+        sender = packet.get_source_server_address()
+        packet.set_source_server_address(self.get_server_address())
+        self.send_broadcast_packet(packet, sender)
 
         print("Message body  :  " + packet.get_body())
 
@@ -741,7 +1216,7 @@ class Peer:
         :rtype: bool
         """
 
-        return self.parent_address == address or self.left_child == address or self.right_child == address
+        return self.parent_address == address or address in self.children
         pass
 
     def __get_neighbour(self, sender):
@@ -779,16 +1254,14 @@ class Peer:
             if node is not None:
                 self.stream.remove_node(node)
             self.parent_address = None
-        if self.left_child is not None:
-            node = self.stream.get_node_by_server(self.left_child[0], self.left_child[1])
-            if node is not None:
-                self.stream.remove_node(node)
-            self.left_child = None
-        if self.right_child is not None:
-            node = self.stream.get_node_by_server(self.right_child[0], self.right_child[1])
+        for child in self.children:
+            node = self.stream.get_node_by_server(child[0], child[1])
             if node is not None:
                 self.stream.remove_node(node)
-            self.right_child = None
+        self.children = []
+        self.reunion_entries = {}
+        self.reunion_routes = {}
+        self.reunion_scheduler.stop()
         self.connection_timer = None
         self.state = 'registered'
 
@@ -799,14 +1272,14 @@ class Peer:
                 self.stream.remove_node(node)
                 self.parent_address = None
                 self.deep_disconnect()
-        if self.left_child is not None:
-            node = self.stream.get_node_by_server(self.left_child[0], self.left_child[1])
-            if node is not None and node.get_server_address() == entry:
-                self.stream.remove_node(node)
-                self.left_child = None
-        if self.right_child is not None:
-            node = self.stream.get_node_by_server(self.right_child[0], self.right_child[1])
-            if node is not None and node.get_server_address() == entry:
+        if entry in self.children:
+            node = self.stream.get_node_by_server(entry[0], entry[1])
+            if node is not None:
                 self.stream.remove_node(node)
-                self.right_child = None
+            self.__remove_child(entry)
+
+    def __remove_child(self, address):
+        # Along with the routes to its sub-tree.
+        self.children.remove(address)
+        self.reunion_routes = {origin: child for origin, child in self.reunion_routes.items() if child != address}
 
@@ -1,11 +1,19 @@
 from src.tools.simpletcp.tcpserver import TCPServer
 
+from src.Packet import PacketFactory, PacketFramer, WIRE_V1, WIRE_V2, encode_v2, set_wire_version, \
+    source_key_of, unbundle, wire_readable, wire_version_field, wire_version_of
+from src.tools.IngressQueue import IngressQueue
 from src.tools.Node import Node
 import threading
+import time
+
+# Upper bound of the packets put in one Bundle, in bytes; More packets than that go in several Bundles.
+MAX_BUNDLE_SIZE = 65536
 
 
 class Stream:
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, ack_window=16, wakeup=None, in_buf_capacity=10000, wire_version=WIRE_V2,
+                 in_buf_wait=1.0):
         """
         The Stream object constructor.
 
@@ -15,32 +23,98 @@ class Stream:
 
         :param ip: 15 characters
         :param port: 5 characters
+        :param ack_window: ACK window of the nodes we connect to; see Node.
+        :param wakeup: Event that is set whenever a packet is put in the input buffer.
+        :param in_buf_capacity: Maximum number of packets waiting in the input buffer; None means unbounded.
+        :param wire_version: Highest wire format we read and send; see Wire Format v2 in Packet.
+        :param in_buf_wait: Seconds a received packet may wait for room in a full input buffer before it is dropped.
+
+        :type wakeup: threading.Event
+        :type in_buf_capacity: int
+        :type wire_version: int
+        :type in_buf_wait: float
         """
 
         self.ip = Node.parse_ip(ip)
         self.port = Node.parse_port(port)
-
-        self._server_in_buf = []
+        self.ack_window = ack_window
+        self.wire_version = wire_version
+        self.in_buf_wait = in_buf_wait
+        self.wakeup = wakeup if wakeup is not None else threading.Event()
+
+        self._server_in_buf = IngressQueue(capacity=in_buf_capacity)
+        # One PacketFramer for every open connection, keyed by its address.
+        self._framers = dict()
+        # Highest wire format every neighbour reads, keyed by its packed server address, as the Version field of
+        # its packets tells; and the server address of every open connection, to forget it when it is closed.
+        self._link_versions = dict()
+        self._link_of_connection = dict()
+        # Counters of the Bundles sent and the packets that went in them.
+        self.bundles_sent = 0
+        self.packets_bundled = 0
+        # Dropped packets of the input buffer that have been reported, and when; Drops are reported once a second.
+        self._drops_reported = 0
+        self._drops_reported_at = 0
 
         def callback(address, queue, data):
             """
             The callback function will run when a new data received from server_buffer.
+            Only whole packets are put in the input buffer; each one is acknowledged separately, and a Bundle is
+            acknowledged once and then split into its packets.
+            A packet is only acknowledged once it is in the input buffer: while the buffer is full we wait, and the
+            senders wait for our ACKs in turn, so they slow down to our pace instead of losing packets.
 
             :param address: Source address.
             :param queue: Response queue.
             :param data: The data received from the socket.
             :return:
             """
-            queue.put(bytes('ACK', 'utf8'))
-            self._server_in_buf.append(data)
+            framer = self._framers.get(address)
+            if framer is None:
+                framer = self._framers[address] = PacketFramer()
+            for frame in framer.feed(data):
+                key = source_key_of(frame)
+                self._link_versions[key] = wire_readable(wire_version_of(frame))
+                self._link_of_connection[address] = key
+                if not self._server_in_buf.put_all(unbundle(frame), self.in_buf_wait):
+                    self.__report_drops()
+                self.wakeup.set()
+                # Also after a drop; An ACK that never comes would shrink the sender's window for good.
+                queue.put(bytes('ACK', 'utf8'))
+
+        def close_callback(address):
+            """
+            Forget the partial packet of a closed connection.
+
+            :param address: Source address.
+            :return:
+            """
+            self._framers.pop(address, None)
+            key = self._link_of_connection.pop(address, None)
+            if key is not None and key not in self._link_of_connection.values():
+                self._link_versions.pop(key, None)
 
-        self.tcp_server = TCPServer(self.ip, int(self.port), callback)
+        self.tcp_server = TCPServer(self.ip, int(self.port), callback, close_callback=close_callback)
         self.server_thread = threading.Thread(target=self.tcp_server.run)
         self.server_thread.start()
 
         self.nodes = []
+        # The nodes keyed by their packed server address; And the addresses to connect to once there is something
+        # to send them, with whether they are register connections.
+        self._nodes_by_key = dict()
+        self._lazy_nodes = dict()
         pass
 
+    def __report_drops(self):
+        # One line a second at most; the input buffer is full, so this is no time for more work.
+        now = time.monotonic()
+        if now - self._drops_reported_at < 1:
+            return
+        dropped = self._server_in_buf.dropped
+        print("Input buffer is full; " + str(dropped - self._drops_reported) + " packets dropped.")
+        self._drops_reported = dropped
+        self._drops_reported_at = now
+
     def get_server_address(self):
         """
 
@@ -57,31 +131,58 @@ class Stream:
         """
         self._server_in_buf.clear()
 
-    def add_node(self, server_address: object, set_register_connection: object = False) -> object:
+    def get_in_buf_counters(self):
+        """
+
+        :return: Enqueued, dropped and drained packet counters of the input buffer.
+        :rtype: dict
+        """
+        return self._server_in_buf.get_counters()
+
+    def add_node(self, server_address: object, set_register_connection: object = False, lazy=False) -> object:
         # FIXME check kon age ba in adress node dashtim moshkel pish naiad o node dobare alaki nasaze
         """
         Will add new a node to our Stream.
 
         :param server_address: New node TCPServer address.
         :param set_register_connection: Shows that is this connection a register_connection or not.
+        :param lazy: Only connect to the node when the first message is added for it, see add_message_to_out_buff.
 
         :type server_address: tuple
         :type set_register_connection: bool
+        :type lazy: bool
 
         :return:
         """
         # FIXME when should a node be marked as root?
-        if self.get_node_by_server(server_address[0], server_address[1]) is not None:
+        key = Node.pack_address(server_address)
+        if key in self._nodes_by_key:
             print("A Node with ip: " + server_address[0] + " and port: " + server_address[1] + " already exists!")
             return
+        if lazy:
+            self._lazy_nodes[key] = set_register_connection
+            return
+        self._lazy_nodes.pop(key, None)
         try:
-            new_node = Node(server_address, set_register=set_register_connection)
+            new_node = Node(server_address, set_register=set_register_connection, ack_window=self.ack_window)
         except ConnectionRefusedError:
             print("This address does not exist in network! " + str(server_address))
             return
         self.nodes.append(new_node)
+        self._nodes_by_key[key] = new_node
         pass
 
+    def forget_lazy_node(self, server_address):
+        """
+        Don't connect to a node added with lazy=True anymore.
+
+        :param server_address: The node TCPServer address.
+        :type server_address: tuple
+
+        :return:
+        """
+        self._lazy_nodes.pop(Node.pack_address(server_address), None)
+
     def remove_node(self, node):
         """
         Remove the node from our Stream.
@@ -95,6 +196,7 @@ class Stream:
         :return:
         """
         self.nodes.remove(node)
+        self._nodes_by_key.pop(node.packed_address, None)
         node.close()
         pass
 
@@ -102,25 +204,15 @@ class Stream:
         """
 
         Will find the node that has IP/Port address of input.
-
-        Warnings:
-            1. Before comparing the address parse it to a standard format with Node.parse_### functions.
+        Nodes are looked up by their packed address, so every format of the address finds the node.
 
         :param ip: input address IP
         :param port: input address Port
 
-        :return: The node that input address.
+        :return: The node that input address; None if we are not connected to it, even if it was added with lazy=True.
         :rtype: Node
         """
-        p_ip = Node.parse_ip(ip)
-        p_port = Node.parse_port(port)
-        the_node = None
-        for node in self.nodes:
-            if node.server_ip == p_ip and node.server_port == p_port:
-                the_node = node
-                break
-        return the_node
-        pass
+        return self._nodes_by_key.get(Node.pack_address((ip, port)))
 
     def add_message_to_out_buff(self, address, message):
         """
@@ -136,6 +228,9 @@ class Stream:
         :return:
         """
         node = self.get_node_by_server(address[0], address[1])
+        if node is None and Node.pack_address(address) in self._lazy_nodes:
+            self.add_node(address, set_register_connection=self._lazy_nodes[Node.pack_address(address)])
+            node = self.get_node_by_server(address[0], address[1])
         try:
             node.add_message_to_out_buff(message)
         except:
@@ -144,12 +239,13 @@ class Stream:
 
     def read_in_buf(self):
         """
-        Only returns the input buffer of our TCPServer.
+        Takes every packet out of the input buffer of our TCPServer.
+        Packets that arrive meanwhile stay in the buffer for the next call, so there is no need to clear it.
 
         :return: TCPServer input buffer.
         :rtype: list
         """
-        return self._server_in_buf
+        return self._server_in_buf.drain()
 
     def send_messages_to_node(self, node):
         """
@@ -162,17 +258,69 @@ class Stream:
         :param node:
         :type node Node
 
-        :return:
+        :return: Bytes and packets flushed to the node; Packets in Bundles are counted one by one.
+        :rtype: tuple
         """
+        packets = len(node.out_buff)
+        self.__encode_out_buff(node)
         try:
-            node.send_message()
+            return node.send_message(packets=packets)
         except RuntimeError:
             self.remove_node(node)
         except ValueError:
             # FIXME might wanna do sth
             print("Sth Went Wrong")
             pass
-        pass
+        return 0, 0
+
+    def __encode_out_buff(self, node):
+        """
+        Put the buffered packets of 'node' in the wire format of its link: v2 if both of us read it, otherwise the
+        usual format with the highest format we read in its Version field.
+        On a v2 link, two or more packets are sent in Bundles of up to MAX_BUNDLE_SIZE bytes.
+
+        :param node: The node whose buffer is about to be sent.
+        :type node: Node
+
+        :return:
+        """
+        node.wire_version = min(self.wire_version, self._link_versions.get(node.packed_address, WIRE_V1))
+        out_buff = node.out_buff
+        if node.wire_version >= WIRE_V2:
+            out_buff[:] = [encode_v2(buf, self.wire_version) for buf in out_buff]
+            if len(out_buff) > 1:
+                out_buff[:] = self.__bundle(out_buff)
+            return
+        version = wire_version_field(WIRE_V1, self.wire_version)
+        # The same buffer may be queued for other nodes too; they all get the same Version.
+        out_buff[:] = [set_wire_version(buf, version) for buf in out_buff]
+
+    def __bundle(self, frames):
+        """
+        :param frames: Packets in format 2.
+        :type frames: list
+
+        :return: The same packets in Bundles; A packet that fills a Bundle by itself is left as it is.
+        :rtype: list
+        """
+        out = []
+        group = []
+        size = 0
+        for frame in frames + [None]:
+            if frame is None or (group and size + len(frame) > MAX_BUNDLE_SIZE):
+                if len(group) > 1:
+                    bundle = PacketFactory.new_bundle_packet(self.get_server_address(), group)
+                    out.append(encode_v2(bundle.get_buf(), self.wire_version))
+                    self.bundles_sent += 1
+                    self.packets_bundled += len(group)
+                else:
+                    out += group
+                group = []
+                size = 0
+            if frame is not None:
+                group.append(frame)
+                size += len(frame)
+        return out
 
     def send_out_buf_messages(self, only_register=False):
         """
@@ -5,14 +5,17 @@ from tkinter import Frame, Button, Tk, Entry, Label
 class Application(Frame):
     def advertise(self):
         self.__buffer.append('Advertise')
+        self.__notify()
         self.output['text'] = 'advertise sent!'
 
     def register(self):
         self.__buffer.append('Register')
+        self.__notify()
         self.output['text'] = 'register sent!'
 
     def send_message(self):
         self.__buffer.append('SendMessage ' + self.input.get())
+        self.__notify()
         self.output['text'] = 'message sent!'
 
     def createWidgets(self):
@@ -38,9 +41,14 @@ class Application(Frame):
         self.send_button["command"] = self.send_message
         self.send_button.grid(row=1, column=10)
 
-    def __init__(self, master, buffer):
+    def __notify(self):
+        if self.__wakeup is not None:
+            self.__wakeup.set()
+
+    def __init__(self, master, buffer, wakeup=None):
         Frame.__init__(self, master, width=300, height=200)
         self.__buffer = buffer
+        self.__wakeup = wakeup
         self.pack(fill=None, expand=False)
         self.createWidgets()
 
@@ -48,6 +56,14 @@ class Application(Frame):
 class UserInterface(threading.Thread):
     buffer = []
 
+    def __init__(self, wakeup=None):
+        """
+        :param wakeup: Event that is set whenever a new command is buffered.
+        :type wakeup: threading.Event
+        """
+        threading.Thread.__init__(self)
+        self.wakeup = wakeup
+
     def run(self):
         """
         Which the user or client sees and works with.
@@ -56,7 +72,7 @@ class UserInterface(threading.Thread):
 
 
         root = Tk()
-        app = Application(root, self.buffer)
+        app = Application(root, self.buffer, self.wakeup)
         app.mainloop()
         root.destroy()
 
@@ -0,0 +1,274 @@
+import io
+import mmap
+import os
+import struct
+from array import array
+
+from src.tools.NetworkGraph import NetworkGraph
+from src.tools.Node import Node
+from src.tools.Registry import Registry
+
+# File header: magic and generation. The snapshot also has the number of registered addresses.
+_WAL_HEADER = struct.Struct('=8sQ')
+_SNAPSHOT_HEADER = struct.Struct('=8sQQ')
+_WAL_MAGIC = b'NGWAL001'
+_SNAPSHOT_MAGIC = b'NGSNP001'
+
+# A record: operation, packed address of the node and a packed address or a count.
+_RECORD = struct.Struct('=Bqq')
+
+_REGISTER = 1
+_UNREGISTER = 2
+_ADD_NODE = 3
+_REMOVE_NODE = 4
+_MOVE_NODE = 5
+_TURN_ON_NODE = 6
+_TURN_OFF_NODE = 7
+# Followed by one _PLACE record for every child.
+_REMOVE_AND_REPARENT = 8
+_PLACE = 9
+
+
+class GraphJournal:
+    def __init__(self, path, snapshot_every=10000):
+        """
+        Keeps the state of the root (the NetworkGraph and the registered addresses) on disk, so a restarted root
+        can continue where it stopped instead of making every peer register and advertise again.
+
+        Every change is appended to a write-ahead log ('path'.wal) as a fixed size binary record. Once the log has
+        'snapshot_every' records the whole state is written to 'path'.snap and a new, empty log is started. Both
+        files carry a generation number, so a log is only replayed on top of the snapshot it belongs to.
+
+        Records are written with one unbuffered write each, so they survive a crash of the process; the snapshot is
+        synced before it replaces the old one, but the log is not synced on every record.
+
+        The same records are given to the listeners, e.g. for sending them to a standby root, which rebuilds the
+        state from encode_state and apply.
+
+        :param path: Path of the journal files without the extension; None for not keeping any files.
+        :param snapshot_every: Number of log records after which a new snapshot is taken.
+
+        :type path: str
+        :type snapshot_every: int
+        """
+        self.snapshot_path = None if path is None else path + '.snap'
+        self.wal_path = None if path is None else path + '.wal'
+        self.snapshot_every = snapshot_every
+        self.generation = 0
+        self.records = 0
+        self._wal = None
+        # Called with the bytes of every new record.
+        self.listeners = []
+
+    def load(self, reunion_timeout=None):
+        """
+        Rebuild the saved state: read the snapshot and replay the log on top of it.
+
+        :param reunion_timeout: See NetworkGraph.
+        :type reunion_timeout: float
+
+        :return: The NetworkGraph and the Registry, or None if nothing was saved.
+        :rtype: tuple
+        """
+        if self.snapshot_path is None or not os.path.exists(self.snapshot_path):
+            return None
+        with open(self.snapshot_path, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                graph, registered, self.generation = self.decode_state(buffer, reunion_timeout)
+            finally:
+                buffer.close()
+        self.__replay(graph, registered)
+        return graph, registered
+
+    def __replay(self, graph, registered):
+        if not os.path.exists(self.wal_path):
+            return
+        with open(self.wal_path, 'rb') as file:
+            data = file.read()
+        if len(data) < _WAL_HEADER.size:
+            return
+        magic, generation = _WAL_HEADER.unpack_from(data, 0)
+        if magic != _WAL_MAGIC or generation != self.generation:
+            # A log of an older snapshot; everything in it is in the snapshot already.
+            return
+        self.apply(graph, registered, data[_WAL_HEADER.size:])
+
+    @staticmethod
+    def encode_state(graph, registered, generation=0):
+        """
+
+        :return: A snapshot of 'graph' and 'registered' in the format of the snapshot file.
+        :rtype: bytes
+        """
+        file = io.BytesIO()
+        GraphJournal.__write_state(file, graph, registered, generation)
+        return file.getvalue()
+
+    @staticmethod
+    def decode_state(buffer, reunion_timeout=None):
+        """
+        Read a snapshot made by encode_state or snapshot.
+
+        :param buffer: The snapshot.
+        :param reunion_timeout: See NetworkGraph.
+
+        :return: The NetworkGraph, the Registry and the generation of the snapshot.
+        :rtype: tuple
+        """
+        magic, generation, count = _SNAPSHOT_HEADER.unpack_from(buffer, 0)
+        if magic != _SNAPSHOT_MAGIC:
+            raise ValueError("Not a journal snapshot")
+        offset = _SNAPSHOT_HEADER.size
+        keys = array('q')
+        keys.frombytes(buffer[offset:offset + count * keys.itemsize])
+        offset += count * keys.itemsize
+        graph, _ = NetworkGraph.read_snapshot(buffer, offset, reunion_timeout)
+        registry = Registry()
+        registry.import_keys(keys)
+        return graph, registry, generation
+
+    @staticmethod
+    def __write_state(file, graph, registered, generation):
+        keys = registered.export_keys()
+        file.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, generation, len(keys)))
+        file.write(keys.tobytes())
+        graph.write_snapshot(file)
+
+    @staticmethod
+    def apply(graph, registered, data):
+        """
+        Replay records on 'graph' and 'registered'; 'graph' must not have a journal, or the records would be
+        journaled again.
+
+        :param graph: The NetworkGraph.
+        :param registered: The Registry.
+        :param data: Records, as written to the log or given to the listeners.
+
+        :type graph: NetworkGraph
+        :type registered: Registry
+        :type data: bytes
+
+        :return:
+        """
+        # A record that was cut off by a crash is dropped.
+        records = list(_RECORD.iter_unpack(data[:len(data) - len(data) % _RECORD.size]))
+        index = 0
+        while index < len(records):
+            op, key, arg = records[index]
+            index += 1
+            address = Node.unpack_address(key)
+            if op == _REGISTER:
+                registered.add(address)
+            elif op == _UNREGISTER:
+                registered.remove(address)
+            elif op == _ADD_NODE:
+                graph.add_node(address[0], address[1], Node.unpack_address(arg))
+                registered.confirm(address)
+            elif op == _REMOVE_NODE:
+                graph.remove_node(address)
+            elif op == _MOVE_NODE:
+                graph.move_node(address, Node.unpack_address(arg))
+            elif op == _TURN_ON_NODE:
+                graph.turn_on_node(address)
+            elif op == _TURN_OFF_NODE:
+                graph.turn_off_node(address)
+            elif op == _REMOVE_AND_REPARENT:
+                places = records[index:index + arg]
+                if len(places) < arg:
+                    # The process died while writing this change.
+                    break
+                index += arg
+                graph.remove_and_reparent(address, [Node.unpack_address(parent) for _, _, parent in places])
+
+    def open(self, graph, registered):
+        """
+        Start journaling 'graph' and 'registered': a snapshot of them is taken right away, and from now on 'graph'
+        reports its changes to the journal. Registrations have to be reported with register and unregister.
+
+        :param graph: The NetworkGraph of the root.
+        :param registered: The Registry.
+
+        :type graph: NetworkGraph
+        :type registered: Registry
+
+        :return:
+        """
+        self.snapshot(graph, registered)
+        graph.journal = self
+
+    def snapshot(self, graph, registered):
+        """
+        Write the whole state to a new snapshot and start a new, empty log.
+
+        :param graph: The NetworkGraph of the root.
+        :param registered: The Registry.
+
+        :type graph: NetworkGraph
+        :type registered: Registry
+
+        :return:
+        """
+        self.generation += 1
+        self.records = 0
+        if self.snapshot_path is None:
+            return
+        temporary_path = self.snapshot_path + '.tmp'
+        with open(temporary_path, 'wb') as file:
+            self.__write_state(file, graph, registered, self.generation)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+
+        if self._wal is not None:
+            os.close(self._wal)
+        self._wal = os.open(self.wal_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.write(self._wal, _WAL_HEADER.pack(_WAL_MAGIC, self.generation))
+
+    def should_snapshot(self):
+        """
+
+        :return: Whether the log is long enough for a new snapshot.
+        :rtype: bool
+        """
+        return self.snapshot_path is not None and self.records >= self.snapshot_every
+
+    def close(self):
+        if self._wal is not None:
+            os.close(self._wal)
+            self._wal = None
+
+    def __append(self, data):
+        if self._wal is not None:
+            os.write(self._wal, data)
+        self.records += len(data) // _RECORD.size
+        for listener in self.listeners:
+            listener(data)
+
+    def register(self, address):
+        self.__append(_RECORD.pack(_REGISTER, Node.pack_address(address), 0))
+
+    def unregister(self, address):
+        self.__append(_RECORD.pack(_UNREGISTER, Node.pack_address(address), 0))
+
+    # Called by NetworkGraph with packed addresses.
+
+    def add_node(self, key, parent_key):
+        self.__append(_RECORD.pack(_ADD_NODE, key, parent_key))
+
+    def remove_node(self, key):
+        self.__append(_RECORD.pack(_REMOVE_NODE, key, 0))
+
+    def move_node(self, key, parent_key):
+        self.__append(_RECORD.pack(_MOVE_NODE, key, parent_key))
+
+    def turn_on_node(self, key):
+        self.__append(_RECORD.pack(_TURN_ON_NODE, key, 0))
+
+    def turn_off_node(self, key):
+        self.__append(_RECORD.pack(_TURN_OFF_NODE, key, 0))
+
+    def remove_and_reparent(self, key, places):
+        # One write for the whole change, so it is not torn apart by a crash in the middle.
+        self.__append(_RECORD.pack(_REMOVE_AND_REPARENT, key, len(places)) +
+                      b''.join(_RECORD.pack(_PLACE, child_key, parent_key) for child_key, parent_key in places))
@@ -0,0 +1,125 @@
+import threading
+
+
+class IngressQueue:
+    def __init__(self, capacity=None):
+        """
+        The buffer between the TCP server thread, which puts received packets in it, and the Peer thread,
+        which takes all of them out at once.
+
+        The lock is only held for an append or for swapping the list with an empty one, so neither thread
+        waits for the other one's work and nothing that arrives during a drain can be lost. Only put_all may wait,
+        for the Peer thread to make room.
+
+        :param capacity: Maximum number of buffered packets; packets arriving while it is full are dropped.
+                         None means unbounded.
+
+        :type capacity: int
+        """
+        self.capacity = capacity
+        self._items = []
+        self._lock = threading.Lock()
+        # Notified whenever the queue is emptied, for put_all.
+        self._room = threading.Condition(self._lock)
+
+        # Counters for sizing the queue.
+        self.enqueued = 0
+        self.dropped = 0
+        self.drained = 0
+
+    def put(self, item):
+        """
+        Add an item unless the queue is full.
+
+        :param item: The received packet.
+
+        :return: Whether the item was accepted.
+        :rtype: bool
+        """
+        with self._lock:
+            if self.capacity is not None and len(self._items) >= self.capacity:
+                self.dropped += 1
+                return False
+            self._items.append(item)
+            self.enqueued += 1
+            return True
+
+    def put_many(self, items):
+        """
+        Add several items with one lock acquisition; the ones that do not fit are dropped.
+
+        :param items: The received packets.
+        :type items: list
+
+        :return: Number of accepted items.
+        :rtype: int
+        """
+        with self._lock:
+            if self.capacity is None:
+                accepted = len(items)
+            else:
+                accepted = max(0, min(len(items), self.capacity - len(self._items)))
+            self._items.extend(items[:accepted])
+            self.enqueued += accepted
+            self.dropped += len(items) - accepted
+            return accepted
+
+    def put_all(self, items, timeout=None):
+        """
+        Add all of the items, waiting up to 'timeout' seconds for room if the queue is full; none of them are added
+        if there is no room by then. An empty queue always takes them, however many they are.
+
+        :param items: The received packets.
+        :param timeout: Seconds to wait for room; None waits as long as it takes.
+
+        :type items: list
+        :type timeout: float
+
+        :return: Whether the items were accepted; otherwise they are counted as dropped.
+        :rtype: bool
+        """
+        with self._room:
+            if self.capacity is not None and not self._room.wait_for(
+                    lambda: not self._items or len(self._items) + len(items) <= self.capacity, timeout):
+                self.dropped += len(items)
+                return False
+            self._items.extend(items)
+            self.enqueued += len(items)
+            return True
+
+    def drain(self):
+        """
+        Take out every buffered item; the queue is left empty.
+
+        :return: The items in arrival order.
+        :rtype: list
+        """
+        with self._lock:
+            items, self._items = self._items, []
+            self.drained += len(items)
+            self._room.notify_all()
+        return items
+
+    def clear(self):
+        """
+        Discard every buffered item; they are counted as dropped.
+
+        :return:
+        """
+        with self._lock:
+            self.dropped += len(self._items)
+            self._items = []
+            self._room.notify_all()
+
+    def get_counters(self):
+        """
+
+        :return: The enqueued, dropped and drained counters and the current length.
+        :rtype: dict
+        """
+        with self._lock:
+            return {'enqueued': self.enqueued, 'dropped': self.dropped, 'drained': self.drained,
+                    'length': len(self._items)}
+
+    def __len__(self):
+        return len(self._items)
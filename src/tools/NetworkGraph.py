@@ -1,57 +1,390 @@
-import time
-
-import collections
+import heapq
+import struct
+from array import array
+from collections.abc import Mapping
+
+from src.tools.Node import Node
+from src.tools.TimerWheel import TimerWheel
+
+# Marks an unused node id, or a missing parent/child.
+_NONE = -1
+# Marks a deleted entry of the address table.
+_DELETED = -2
+# Snapshot header: magic, byte order mark, fan-out, number of id slots, root id, number of nodes, table size,
+# used table slots, free ids, depth levels and the default hop.
+_SNAPSHOT_HEADER = struct.Struct('=4sIiiiiiiiiq')
+_SNAPSHOT_MAGIC = b'NGR1'
+_BYTE_ORDER_MARK = 0x01020304
+# Latency guessed for a hop that has not been measured yet, in microseconds, until there are measurements.
+_DEFAULT_HOP = 10000
 
 
 class GraphNode:
-    def __init__(self, address):
-        self.address = address
-        self.parent = None
-        self.left_child = None
-        self.right_child = None
-        self.reunion_timer = 0
-        self.alive = True
+    __slots__ = ('_graph', '_id', '_address')
 
-        pass
+    def __init__(self, address, graph=None, node_id=_NONE):
+        """
+        A node of the NetworkGraph.
 
-    def set_parent(self, parent):
-        self.parent = parent
-        pass
+        The node's data lives in the columns of its NetworkGraph; a GraphNode is only a view of one node id.
+        A GraphNode that is not in a NetworkGraph yet (like the root before the graph is made) only carries its
+        address.
 
-    def set_address(self, new_address):
-        self.address = new_address
-        pass
+        Warnings:
+            1. Don't keep a GraphNode after its node is removed; the id is reused for the next added node.
 
-    def __reset(self):
-        # self.address=None
-        self.parent = None
-        pass
+        :param address: IP/Port address of the node.
+        :param graph: The NetworkGraph that holds the node.
+        :param node_id: The node's id in 'graph'.
+        """
+        self._graph = graph
+        self._id = node_id
+        self._address = address
+
+    @property
+    def address(self):
+        if self._graph is None:
+            return self._address
+        return Node.unpack_address(self._graph._key[self._id])
+
+    @property
+    def parent(self):
+        """
+        :return: Address of the parent, or None.
+        :rtype: tuple
+        """
+        if self._graph is None:
+            return None
+        return self._graph._address_of(self._graph._parent[self._id])
 
-    def add_child(self, child):
+    @property
+    def children(self):
+        """
+        :return: The children of the node, in the order they joined.
+        :rtype: list
+        """
+        if self._graph is None:
+            return []
+        return [GraphNode(None, self._graph, child_id) for child_id in self._graph._children_of(self._id)]
+
+    @property
+    def left_child(self):
+        children = self.children
+        return children[0] if len(children) > 0 else None
+
+    @property
+    def right_child(self):
+        children = self.children
+        return children[1] if len(children) > 1 else None
+
+    @property
+    def alive(self):
+        return self._graph is None or bool(self._graph._alive[self._id])
+
+    @property
+    def depth(self):
+        """
+        :return: Distance from the root of the network.
+        :rtype: int
+        """
+        return 0 if self._graph is None else self._graph._depth[self._id]
 
-        pass
+    @property
+    def latency(self):
+        """
+        :return: Estimated round trip time from the root to this node and back in seconds.
+        :rtype: float
+        """
+        return 0.0 if self._graph is None else self._graph._latency[self._id] / 1e6
 
     def number_of_child(self):
-        cnt = 0
-        if self.right_child is not None: cnt += 1
-        if self.left_child is not None: cnt += 1
-        return cnt
+        if self._graph is None:
+            return 0
+        return self._graph._number_of_child(self._id)
+
+    def __eq__(self, other):
+        return isinstance(other, GraphNode) and self.address == other.address
+
+    def __hash__(self):
+        return hash(self.address)
+
+
+class _NodeTable(Mapping):
+    """
+    NetworkGraph.nodes: a read-only mapping from address to GraphNode over the graph's columns.
+    """
+
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __getitem__(self, address):
+        node_id = self._graph._id_of(address)
+        if node_id == _NONE:
+            raise KeyError(address)
+        return GraphNode(None, self._graph, node_id)
+
+    def __contains__(self, address):
+        return self._graph._id_of(address) != _NONE
+
+    def __iter__(self):
+        key = self._graph._key
+        for node_id in range(len(key)):
+            if key[node_id] != _NONE:
+                yield Node.unpack_address(key[node_id])
+
+    def __len__(self):
+        return self._graph.number_of_nodes
 
 
 class NetworkGraph:
-    def __init__(self, root):
-        self.root = root
-        root.alive = True
+    def __init__(self, root, reunion_timeout=None, fan_out=2):
+        """
+        The tree of the network, as known to the root.
+
+        Nodes are identified by integer ids and stored in array columns instead of one Python object per node:
+        packed address, parent, children, depth and alive flag, with the reunion timers in a TimerWheel
+        keyed by the same ids. Addresses are interned in an open addressing table of ids. A node costs about
+        110 bytes with the default fan-out, so the root can keep 100k+ peers. GraphNode and 'nodes' give the old
+        object view of it.
+
+        Every node has up to 'fan_out' children, so the depth of the tree grows as log(n) / log(fan_out): a bigger
+        fan-out means fewer hops for broadcasts and Reunion Hellos, and more upload for every peer.
 
-        self.nodes = {root.address: root}
+        Peers report the round trip time of their Reunion Hellos (see report_rtt), which is the latency of their
+        path to the root. New and moved nodes are placed under the node with the lowest such latency, so the worst
+        root-to-leaf latency stays low; Until nodes are measured every hop counts the same and this is BFS order.
+
+        :param root: The root of the network.
+        :param reunion_timeout: Seconds a node may stay without Reunion Hello before it times out; None disables it.
+        :param fan_out: Maximum number of children of a node.
+
+        :type root: GraphNode
+        :type reunion_timeout: float
+        :type fan_out: int
+        """
+
+        if fan_out < 1:
+            raise ValueError("fan_out must be at least 1")
+        self.fan_out = fan_out
+
+        # Node columns, indexed by node id. The children of node i are in _children[i * fan_out:
+        # i * fan_out + _child_count[i]], in the order they joined.
+        self._key = array('q')
+        self._parent = array('i')
+        self._children = array('i')
+        self._child_count = array('i')
+        self._depth = array('i')
+        # Estimated latency of the node's path to the root and of its own hop, in microseconds.
+        self._latency = array('q')
+        self._hop = array('q')
+        self._alive = bytearray()
+        # Number of nodes at every depth, for the balance of the tree. The nodes of every depth are also in a doubly
+        # linked list threaded through _depth_next and _depth_prev, which starts at _depth_head of the depth.
+        self._depth_count = array('i')
+        self._depth_head = array('i')
+        self._depth_next = array('i')
+        self._depth_prev = array('i')
+        # Ids of removed nodes, reused before the columns grow.
+        self._free_ids = array('i')
+        self.number_of_nodes = 0
+
+        # Address table: packed address -> id, open addressing with linear probing.
+        self._table = array('i', [_NONE]) * 8
+        self._table_used = 0
+
+        # Heap of the nodes that may have a free child slot, ordered by latency and then depth. An entry is one int
+        # (see __slot_entry), which is much smaller than a tuple. Entries are not removed when a node fills up, moves
+        # or leaves; find_live_node drops them when it meets them.
+        self._free_slots = []
+        # Running average of the measured hop latencies; the guess for nodes that are not measured yet.
+        self.default_hop = _DEFAULT_HOP
+
+        # Gets every change of the tree if set, see GraphJournal.
+        self.journal = None
+
+        # Reunion timers of every node except the root, keyed by node id.
+        self.reunion_timeout = reunion_timeout
+        self.reunion_timers = TimerWheel()
+        # Extra reunion timeout for every level of depth, in seconds; Reunion Summaries are held for up to an interval
+        # by every peer on the way up, so the reports of deep nodes arrive that much later.
+        self.reunion_level_delay = 0
+
+        root_id = self.__new_node(root.address, _NONE)
+        self.root = GraphNode(None, self, root_id)
+        self.nodes = _NodeTable(self)
+
+    # Address table
+
+    def __slot_of(self, key):
+        """
+        :return: The table slot that holds 'key', or the slot where it should be inserted, and its id or _NONE.
+        :rtype: tuple
+        """
+        table = self._table
+        mask = len(table) - 1
+        # Fibonacci hashing; the low bits of addresses (the port) are far from random.
+        slot = (((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 32) & mask
+        insert_at = _NONE
+        while True:
+            node_id = table[slot]
+            if node_id == _NONE:
+                return (slot if insert_at == _NONE else insert_at), _NONE
+            if node_id == _DELETED:
+                if insert_at == _NONE:
+                    insert_at = slot
+            elif self._key[node_id] == key:
+                return slot, node_id
+            slot = (slot + 1) & mask
+
+    def __rebuild_table(self):
+        # Sized for the live nodes only, which also drops the deleted entries.
+        size = 8
+        while size < (self.number_of_nodes + 1) * 4:
+            size *= 2
+        old_table = self._table
+        self._table = array('i', [_NONE]) * size
+        self._table_used = 0
+        for node_id in old_table:
+            if node_id >= 0:
+                slot, _ = self.__slot_of(self._key[node_id])
+                self._table[slot] = node_id
+                self._table_used += 1
+
+    def _id_of(self, address):
+        """
+        :return: The id of the node with 'address', or _NONE.
+        :rtype: int
+        """
+        try:
+            key = Node.pack_address(address)
+        except (ValueError, IndexError, AttributeError, TypeError):
+            return _NONE
+        return self.__slot_of(key)[1]
+
+    def _address_of(self, node_id):
+        return None if node_id == _NONE else Node.unpack_address(self._key[node_id])
+
+    def _node_of(self, node_id):
+        return None if node_id == _NONE else GraphNode(None, self, node_id)
+
+    # Node columns
+
+    def __new_node(self, address, parent_id):
+        key = Node.pack_address(address)
+        depth = 0 if parent_id == _NONE else self._depth[parent_id] + 1
+        hop = 0 if parent_id == _NONE else self.default_hop
+        latency = hop if parent_id == _NONE else self._latency[parent_id] + hop
+        if self._free_ids:
+            node_id = self._free_ids.pop()
+            self._key[node_id] = key
+            self._parent[node_id] = parent_id
+            self._child_count[node_id] = 0
+            self._latency[node_id] = latency
+            self._hop[node_id] = hop
+            self._alive[node_id] = 1
+        else:
+            node_id = len(self._key)
+            self._key.append(key)
+            self._parent.append(parent_id)
+            self._children.extend([_NONE] * self.fan_out)
+            self._child_count.append(0)
+            self._depth.append(_NONE)
+            self._depth_next.append(_NONE)
+            self._depth_prev.append(_NONE)
+            self._latency.append(latency)
+            self._hop.append(hop)
+            self._alive.append(1)
+        if (self._table_used + 1) * 2 > len(self._table):
+            self.__rebuild_table()
+        slot, _ = self.__slot_of(key)
+        if self._table[slot] == _NONE:
+            self._table_used += 1
+        self._table[slot] = node_id
+        self.number_of_nodes += 1
+        self.__set_depth(node_id, depth)
+        self.__push_free_slot(node_id)
+        return node_id
+
+    def __free_node(self, node_id):
+        slot, _ = self.__slot_of(self._key[node_id])
+        self._table[slot] = _DELETED
+        self.reunion_timers.cancel(node_id)
+        self._key[node_id] = _NONE
+        self._parent[node_id] = _NONE
+        self._child_count[node_id] = 0
+        self.__set_depth(node_id, _NONE)
+        self._alive[node_id] = 0
+        self._free_ids.append(node_id)
+        self.number_of_nodes -= 1
+
+    def __set_depth(self, node_id, depth):
+        # _NONE takes the node out of the depth counts.
+        old_depth = self._depth[node_id]
+        if old_depth != _NONE:
+            self._depth_count[old_depth] -= 1
+            self.__unlink_depth(node_id, old_depth)
+        if depth != _NONE:
+            while len(self._depth_count) <= depth:
+                self._depth_count.append(0)
+                self._depth_head.append(_NONE)
+            self._depth_count[depth] += 1
+            self.__link_depth(node_id, depth)
+        self._depth[node_id] = depth
+
+    def __link_depth(self, node_id, depth):
+        head = self._depth_head[depth]
+        self._depth_next[node_id] = head
+        self._depth_prev[node_id] = _NONE
+        if head != _NONE:
+            self._depth_prev[head] = node_id
+        self._depth_head[depth] = node_id
+
+    def __unlink_depth(self, node_id, depth):
+        next_id = self._depth_next[node_id]
+        prev_id = self._depth_prev[node_id]
+        if prev_id != _NONE:
+            self._depth_next[prev_id] = next_id
+        else:
+            self._depth_head[depth] = next_id
+        if next_id != _NONE:
+            self._depth_prev[next_id] = prev_id
+
+    def __nodes_at_depth(self, depth):
+        node_id = self._depth_head[depth] if depth < len(self._depth_head) else _NONE
+        while node_id != _NONE:
+            yield node_id
+            node_id = self._depth_next[node_id]
+
+    def _number_of_child(self, node_id):
+        return self._child_count[node_id]
+
+    def _children_of(self, node_id):
+        start = node_id * self.fan_out
+        return self._children[start:start + self._child_count[node_id]]
+
+    def __slot_entry(self, node_id):
+        # Latency, depth and id packed into one int, so entries compare in that order.
+        return (self._latency[node_id] << 48) | (self._depth[node_id] << 24) | node_id
+
+    def __push_free_slot(self, node_id):
+        if self._child_count[node_id] >= self.fan_out:
+            return
+        if len(self._free_slots) > 2 * self.number_of_nodes + 64:
+            # Mostly stale entries by now; rebuild from the nodes that really have a free slot.
+            self._free_slots = [self.__slot_entry(candidate) for candidate in range(len(self._key))
+                                if self._key[candidate] != _NONE and self._alive[candidate]
+                                and self._child_count[candidate] < self.fan_out]
+            heapq.heapify(self._free_slots)
+        heapq.heappush(self._free_slots, self.__slot_entry(node_id))
 
     def find_live_node(self):
         """
         Here we should find a neighbour for the sender.
-        Best neighbour is the node who is nearest to the root and has not more than one child.
+        Best neighbour is the node who has the lowest latency to the root and has fewer than fan_out children;
+        Among nodes with the same latency, the one nearest to the root.
 
-        Code design suggestion:
-            1. Do a BFS algorithm to find the target.
+        The candidates are kept in a heap, so this is O(log n) amortized instead of a search from the root on
+        every call.
 
         Warnings:
             1. Check whether there is sender node in our NetworkGraph or not; if exist do not return sender node or
@@ -62,76 +395,403 @@ class NetworkGraph:
         :rtype: GraphNode
         """
 
-        frontier = collections.deque()
-        head = self.root
-        frontier.append(head)
-        while head.number_of_child() == 2 or head is None:
-            tmp = frontier.popleft()
-            frontier.append(tmp.left_child)
-            frontier.append(tmp.right_child)
-            head = frontier.popleft()
-            frontier.appendleft(head)
-
-        return head
-
-        pass
+        heap = self._free_slots
+        while heap:
+            entry = heap[0]
+            node_id = entry & 0xFFFFFF
+            if self._key[node_id] != _NONE and self._alive[node_id] and self._child_count[node_id] < self.fan_out \
+                    and self.__slot_entry(node_id) == entry:
+                return GraphNode(None, self, node_id)
+            # The entry is stale: the node is full, turned off, moved, re-measured or gone.
+            heapq.heappop(heap)
+        return None
 
     def find_node(self, ip, port):
 
-        return self.nodes.get((ip, port))
+        return self._node_of(self._id_of((ip, port)))
 
         pass
 
     def turn_on_node(self, node_address):
-        self.nodes[node_address].alive = True
+        node_id = self._id_of(node_address)
+        self._alive[node_id] = 1
+        self.__push_free_slot(node_id)
+        if self.journal is not None:
+            self.journal.turn_on_node(self._key[node_id])
 
         pass
 
     def turn_off_node(self, node_address):
-        self.nodes[node_address].alive = False
+        """
+        Turn off a node and its whole sub-tree: they stay in the graph but are never chosen as a parent and their
+        reunion timers are stopped.
 
-        turned_off_node = self.nodes.get(node_address)
-        turned_off_node.parent = None
+        :param node_address: Address of the node.
+        :type node_address: tuple
 
-        if turned_off_node.left_child is not None:
-            self.turn_off_node(turned_off_node.left_child)
+        :return: Addresses of the turned off nodes, the node first.
+        :rtype: list
+        """
+        node_id = self._id_of(node_address)
+        if node_id == _NONE:
+            return []
+        subtree = self.__collect_subtree(node_id)
+        for sub_id in subtree:
+            self._alive[sub_id] = 0
+            self.reunion_timers.cancel(sub_id)
+        if self.journal is not None:
+            self.journal.turn_off_node(self._key[node_id])
+        return [self._address_of(sub_id) for sub_id in subtree]
+
+    def __collect_subtree(self, node_id):
+        """
+        Walk a sub-tree with an explicit stack, so deep trees can not hit the recursion limit.
 
-        if turned_off_node.right_child is not None:
-            self.turn_off_node(turned_off_node.right_child)
+        :return: Ids of the node and all of its descendants, parents before children.
+        :rtype: list
+        """
+        subtree = []
+        stack = [node_id]
+        while stack:
+            sub_id = stack.pop()
+            subtree.append(sub_id)
+            # Reversed, so the first child is visited first.
+            stack.extend(reversed(self._children_of(sub_id)))
+        return subtree
+
+    def report_rtt(self, node_address, rtt):
+        """
+        Record the measured round trip time of a node's Reunion Hello, i.e. the latency of its path to the root.
+        The difference to its parent's path is the latency of the node's own hop; The path latencies of the node's
+        sub-tree are updated with it.
 
-        turned_off_node.left_child = None
-        turned_off_node.right_child = None
+        :param node_address: Address of the node.
+        :param rtt: Round trip time in seconds.
 
-        pass
+        :type node_address: tuple
+        :type rtt: float
+
+        :return: Whether the node exists in the graph.
+        :rtype: bool
+        """
+        node_id = self._id_of(node_address)
+        if node_id == _NONE or node_id == self.root._id:
+            return False
+        self.__set_hop(node_id, max(0, int(rtt * 1e6) - self._latency[self._parent[node_id]]))
+        return True
+
+    def report_hop_rtt(self, node_address, rtt):
+        """
+        Record the measured round trip time between a node and its parent, e.g. from a reunion Summary.
+
+        :param node_address: Address of the node.
+        :param rtt: Round trip time in seconds.
+
+        :type node_address: tuple
+        :type rtt: float
+
+        :return: Whether the node exists in the graph.
+        :rtype: bool
+        """
+        node_id = self._id_of(node_address)
+        if node_id == _NONE or node_id == self.root._id:
+            return False
+        self.__set_hop(node_id, max(0, int(rtt * 1e6)))
+        return True
+
+    def __set_hop(self, node_id, hop):
+        # The path latency of the whole sub-tree goes through this hop, so it changes for all of them; their heap
+        # entries are pushed again, the old ones become stale. Measured RTTs are noisy, so that is only done when
+        # the path latency moved by more than a quarter of a hop; Each stored path latency is then off by at most
+        # that much for every hop above it.
+        self._hop[node_id] = hop
+        self.default_hop += (hop - self.default_hop) // 8
+        if abs(self._latency[self._parent[node_id]] + hop - self._latency[node_id]) <= self.default_hop // 4:
+            return
+        for sub_id in self.__collect_subtree(node_id):
+            self._latency[sub_id] = self._latency[self._parent[sub_id]] + self._hop[sub_id]
+            self.__push_free_slot(sub_id)
+
+    def reset_reunion_timer(self, node_address):
+        """
+        Restart the reunion timer of a node, e.g. when its Reunion Hello arrives.
+
+        :param node_address: Address of the node.
+        :type node_address: tuple
+
+        :return: Whether the node exists in the graph.
+        :rtype: bool
+        """
+        node_id = self._id_of(node_address)
+        if node_id == _NONE:
+            return False
+        if self.reunion_timeout is not None and node_id != self.root._id:
+            self.reunion_timers.arm(node_id, self.__reunion_timeout_of(node_id))
+        return True
+
+    def __reunion_timeout_of(self, node_id):
+        return self.reunion_timeout + self._depth[node_id] * self.reunion_level_delay
+
+    def restart_reunion_timers(self):
+        """
+        Give every live node a whole reunion timeout from now, e.g. when a new root takes over the graph.
+
+        :return:
+        """
+        if self.reunion_timeout is None:
+            return
+        # Every node of a depth has the same timeout; The root is the only node at depth 0.
+        for depth in range(1, len(self._depth_head)):
+            self.reunion_timers.arm_many([node_id for node_id in self.__nodes_at_depth(depth) if self._alive[node_id]],
+                                         self.reunion_timeout + depth * self.reunion_level_delay)
+
+    def set_root_address(self, address):
+        """
+        Give the root node a new address, e.g. when a standby root takes over; its children stay where they are.
+
+        :param address: The new address of the root.
+        :type address: tuple
+
+        :return:
+        """
+        root_id = self.root._id
+        slot, _ = self.__slot_of(self._key[root_id])
+        self._table[slot] = _DELETED
+        self._key[root_id] = Node.pack_address(address)
+        slot, _ = self.__slot_of(self._key[root_id])
+        if self._table[slot] == _NONE:
+            self._table_used += 1
+        self._table[slot] = root_id
+
+    def pop_timed_out_nodes(self):
+        """
+        Take out the nodes whose reunion timer has expired since the last call.
+        Only the expired timers are touched, not every node in the graph.
+
+        When a node dies, the Reunion Hellos of its whole sub-tree stop at the same time. So a node is not reported
+        while its parent's timer is about to expire too; it is checked again after the parent's deadline, by which
+        time the parent has either been removed (and this node moved, see remove_and_reparent) or proved alive.
+
+        Warnings:
+            1. Removing one of the returned nodes also removes its sub-tree, which may contain other returned nodes.
+
+        :return: Addresses of the timed out nodes.
+        :rtype: list
+        """
+        now = self.reunion_timers.now()
+        expired = self.reunion_timers.expire(now)
+        expired_ids = set(expired)
+        timed_out = []
+        for node_id in expired:
+            parent_id = self._parent[node_id]
+            if parent_id in expired_ids:
+                # The parent is reported now; give it a tick to be handled first.
+                self.reunion_timers.arm(node_id, self.reunion_timers.resolution, now)
+                continue
+            parent_deadline = self.reunion_timers.deadline(parent_id) if parent_id != _NONE else None
+            if parent_deadline is not None and parent_deadline - now < self.reunion_timeout / 2:
+                self.reunion_timers.arm(node_id, parent_deadline - now + self.reunion_timers.resolution, now)
+                continue
+            timed_out.append(self._address_of(node_id))
+        return timed_out
 
     def remove_node(self, node_address):
+        """
+        Remove a node and its whole sub-tree from the graph in one pass; their reunion timers are stopped too.
 
-        removed_node = self.nodes.get(node_address)
-        if removed_node.parent is not None:
-            parent_node = self.nodes[removed_node.parent]
-            if parent_node.left_child is not None and parent_node.left_child.address == node_address:
-                parent_node.left_child = None
-            elif parent_node.right_child is not None and parent_node.right_child.address == node_address:
-                parent_node.right_child = None
+        :param node_address: Address of the node.
+        :type node_address: tuple
 
-        if removed_node is not None:
+        :return: Addresses of the removed nodes, the node first.
+        :rtype: list
+        """
+
+        node_id = self._id_of(node_address)
+        if node_id == _NONE:
+            return []
+        if self.journal is not None:
+            self.journal.remove_node(self._key[node_id])
+        self.__detach(node_id)
+        subtree = self.__collect_subtree(node_id)
+        removed = [self._address_of(sub_id) for sub_id in subtree]
+        for sub_id in subtree:
+            self.__free_node(sub_id)
+        return removed
+
+    def remove_and_reparent(self, node_address, parents=None):
+        """
+        Remove only the node itself and graft the sub-trees of its children onto new parents, instead of dropping
+        them with it. Every child is placed like a new node (see find_live_node) and keeps its whole sub-tree with
+        the measured hop latencies, so only the children have to connect to their new parents; the reunion timers of
+        the moved nodes are restarted to give them time for that.
 
-            if removed_node.left_child is not None:
-                self.remove_node(removed_node.left_child.address)
+        :param node_address: Address of the node.
+        :param parents: New parents for the children, in order, instead of choosing them; for replaying a journal.
 
-            if removed_node.right_child is not None:
-                self.remove_node(removed_node.right_child.address)
-            self.nodes.pop(removed_node.address)
-            removed_node.parent = None
+        :type node_address: tuple
+        :type parents: list
 
-        pass
+        :return: (child address, new parent address) for every child of the removed node.
+        :rtype: list
+        """
+        node_id = self._id_of(node_address)
+        if node_id == _NONE:
+            return []
+        self.__detach(node_id)
+        orphans = list(self._children_of(node_id))
+        subtrees = []
+        for child_id in orphans:
+            self._parent[child_id] = _NONE
+            subtree = self.__collect_subtree(child_id)
+            # Turned off while they are homeless, so no orphan is placed under itself or under another orphan
+            # that is still waiting to be placed.
+            for sub_id in subtree:
+                self._alive[sub_id] = 0
+            subtrees.append(subtree)
+        self._child_count[node_id] = 0
+        node_key = self._key[node_id]
+        self.__free_node(node_id)
+
+        moves = []
+        for index, (child_id, subtree) in enumerate(zip(orphans, subtrees)):
+            if parents is None:
+                parent_id = self.find_live_node()._id
+            else:
+                parent_id = self._id_of(parents[index])
+            self.__attach(child_id, parent_id)
+            self.__settle(subtree)
+            moves.append((child_id, parent_id))
+        if self.journal is not None:
+            self.journal.remove_and_reparent(node_key, [(self._key[child_id], self._key[parent_id])
+                                                        for child_id, parent_id in moves])
+        return [(self._address_of(child_id), self._address_of(parent_id)) for child_id, parent_id in moves]
+
+    def balance_metrics(self):
+        """
+        How far the tree is from balanced: the depth of the deepest node against the least possible maximum depth of
+        a tree with as many nodes and the same fan-out.
+
+        :return: 'nodes', 'max_depth', 'optimal_depth' and 'excess_depth' (max_depth - optimal_depth).
+        :rtype: dict
+        """
+        max_depth = self.__max_depth()
+        optimal_depth = self.__optimal_depth()
+        return {'nodes': self.number_of_nodes, 'max_depth': max_depth, 'optimal_depth': optimal_depth,
+                'excess_depth': max_depth - optimal_depth}
+
+    def __max_depth(self):
+        while len(self._depth_count) > 1 and self._depth_count[-1] == 0:
+            self._depth_count.pop()
+            self._depth_head.pop()
+        return len(self._depth_count) - 1
+
+    def __optimal_depth(self):
+        # The smallest depth d such that a full tree of depth d has room for all the nodes.
+        depth = 0
+        capacity = level = 1
+        while capacity < self.number_of_nodes:
+            level *= self.fan_out
+            capacity += level
+            depth += 1
+        return depth
+
+    def rebalance_step(self, slack=1):
+        """
+        Move one of the deepest nodes to a free slot nearer to the root, if the tree is more than 'slack' levels
+        deeper than it has to be. The nodes at the maximum depth have no children, so only that node has to
+        reconnect; calling this now and then keeps the tree near-balanced without moving many nodes at once.
+
+        The new parent is chosen like for a new node (see find_live_node); if that one is not shallower, nothing
+        is moved, so rebalancing never undoes the latency-aware placement.
+
+        The nodes of every depth are kept in a list, so one of the deepest is found without a scan of the graph.
+
+        :param slack: How many levels deeper than the optimum the tree may be.
+        :type slack: int
+
+        :return: (node address, new parent address) of the moved node, or None.
+        :rtype: tuple
+        """
+        max_depth = self.__max_depth()
+        if max_depth <= self.__optimal_depth() + slack:
+            return None
+        parent = self.find_live_node()
+        if parent is None or parent.depth + 1 >= max_depth:
+            return None
+        for node_id in self.__nodes_at_depth(max_depth):
+            if self._alive[node_id] and node_id != parent._id:
+                break
+        else:
+            return None
+        self.__detach(node_id)
+        self.__attach(node_id, parent._id)
+        self.__settle([node_id])
+        if self.journal is not None:
+            self.journal.move_node(self._key[node_id], self._key[parent._id])
+        return self._address_of(node_id), parent.address
+
+    def move_node(self, node_address, parent_address):
+        """
+        Move a node with its whole sub-tree under another parent.
+
+        Warnings:
+            1. The new parent must have a free slot and must not be in the sub-tree of the node.
+
+        :param node_address: Address of the node.
+        :param parent_address: Address of the new parent.
+
+        :type node_address: tuple
+        :type parent_address: tuple
+
+        :return:
+        """
+        node_id = self._id_of(node_address)
+        parent_id = self._id_of(parent_address)
+        self.__detach(node_id)
+        self.__attach(node_id, parent_id)
+        self.__settle(self.__collect_subtree(node_id))
+        if self.journal is not None:
+            self.journal.move_node(self._key[node_id], self._key[parent_id])
+
+    def __settle(self, subtree):
+        # Fix the depth, latency and index entries of a sub-tree that was attached to a new parent, and give its
+        # nodes a new reunion timeout to reconnect. Parents must come before their children in 'subtree'.
+        for sub_id in subtree:
+            parent_id = self._parent[sub_id]
+            self.__set_depth(sub_id, self._depth[parent_id] + 1)
+            self._latency[sub_id] = self._latency[parent_id] + self._hop[sub_id]
+            self._alive[sub_id] = 1
+            self.__push_free_slot(sub_id)
+            if self.reunion_timeout is not None:
+                self.reunion_timers.arm(sub_id, self.__reunion_timeout_of(sub_id))
+
+    def __detach(self, node_id):
+        # Cut the node off its parent, which gets a free slot again.
+        parent_id = self._parent[node_id]
+        if parent_id != _NONE:
+            start = parent_id * self.fan_out
+            end = start + self._child_count[parent_id]
+            index = start
+            while self._children[index] != node_id:
+                index += 1
+            # Shift the later children down, so they keep their order.
+            self._children[index:end - 1] = self._children[index + 1:end]
+            self._children[end - 1] = _NONE
+            self._child_count[parent_id] -= 1
+            self.__push_free_slot(parent_id)
+        self._parent[node_id] = _NONE
+
+    def __attach(self, node_id, parent_id):
+        self._parent[node_id] = parent_id
+        self._children[parent_id * self.fan_out + self._child_count[parent_id]] = node_id
+        self._child_count[parent_id] += 1
 
     def restart_node(self, node_address):
         the_node = self.find_node(node_address[0], node_address[1])
         if the_node is not None:
-            self.remove_node(the_node.address)
+            self.remove_node(node_address)
         parent_node = self.find_live_node()
-        self.add_node(the_node.address[0], the_node.address[1], parent_node.address)
+        self.add_node(node_address[0], node_address[1], parent_node.address)
         return parent_node
 
     def add_node(self, ip, port, father_address):
@@ -157,11 +817,98 @@ class NetworkGraph:
         :return:
         """
 
-        new_node = GraphNode((ip, port))
-        self.nodes[(ip, port)] = new_node
-        new_node.parent = father_address
-        if self.nodes[father_address].left_child is None:
-            self.nodes[father_address].left_child = new_node
+        father_id = self._id_of(father_address)
+        new_id = self.__new_node((ip, port), father_id)
+        self.__attach(new_id, father_id)
+        self.reset_reunion_timer((ip, port))
+        if self.journal is not None:
+            self.journal.add_node(self._key[new_id], self._key[father_id])
 
-        else:
-            self.nodes[father_address].right_child = new_node
+    # Snapshots
+
+    def __snapshot_columns(self):
+        # 8 byte columns first, so every column of a snapshot is aligned for its item size.
+        return [self._key, self._latency, self._hop, self._parent, self._children, self._child_count, self._depth,
+                self._free_ids, self._depth_count, self._table]
+
+    def write_snapshot(self, file):
+        """
+        Write the whole graph to 'file' as a header followed by the raw columns, so it can be read back with a few
+        memory copies (see read_snapshot). Reunion timers are not saved.
+
+        :param file: A binary file.
+
+        :return: Number of bytes written.
+        :rtype: int
+        """
+        self.__max_depth()
+        header = _SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _BYTE_ORDER_MARK, self.fan_out, len(self._key), self.root._id,
+                                       self.number_of_nodes, len(self._table), self._table_used, len(self._free_ids),
+                                       len(self._depth_count), self.default_hop)
+        written = file.write(header)
+        for column in self.__snapshot_columns():
+            written += file.write(column.tobytes())
+        written += file.write(bytes(self._alive))
+        return written
+
+    @classmethod
+    def read_snapshot(cls, buffer, offset=0, reunion_timeout=None):
+        """
+        Make a graph from a snapshot written by write_snapshot. Every node gets a new reunion timeout, so the nodes
+        that died while the snapshot was on disk time out like the others.
+
+        :param buffer: The snapshot, e.g. a mmap of its file.
+        :param offset: Where the snapshot starts in 'buffer'.
+        :param reunion_timeout: See NetworkGraph.
+
+        :type offset: int
+        :type reunion_timeout: float
+
+        :return: The graph and the offset right after the snapshot.
+        :rtype: tuple
+        """
+        view = memoryview(buffer)
+        (magic, byte_order_mark, fan_out, slots, root_id, number_of_nodes, table_size, table_used, free_ids,
+         depth_levels, default_hop) = _SNAPSHOT_HEADER.unpack_from(view, offset)
+        if magic != _SNAPSHOT_MAGIC or byte_order_mark != _BYTE_ORDER_MARK:
+            raise ValueError("Not a NetworkGraph snapshot of this machine")
+        offset += _SNAPSHOT_HEADER.size
+
+        graph = cls.__new__(cls)
+        graph.fan_out = fan_out
+        graph._key, graph._latency, graph._hop = array('q'), array('q'), array('q')
+        graph._parent, graph._children, graph._child_count, graph._depth = \
+            array('i'), array('i'), array('i'), array('i')
+        graph._free_ids, graph._depth_count, graph._table = array('i'), array('i'), array('i')
+        lengths = [slots, slots, slots, slots, slots * fan_out, slots, slots, free_ids, depth_levels, table_size]
+        for column, length in zip(graph.__snapshot_columns(), lengths):
+            end = offset + length * column.itemsize
+            column.frombytes(view[offset:end])
+            offset = end
+        graph._alive = bytearray(view[offset:offset + slots])
+        offset += slots
+        view.release()
+
+        graph._depth_head = array('i', [_NONE]) * depth_levels
+        graph._depth_next = array('i', [_NONE]) * slots
+        graph._depth_prev = array('i', [_NONE]) * slots
+        for node_id, depth in enumerate(graph._depth):
+            if depth != _NONE:
+                graph.__link_depth(node_id, depth)
+
+        graph.number_of_nodes = number_of_nodes
+        graph._table_used = table_used
+        graph.default_hop = default_hop
+        graph.journal = None
+        graph.reunion_timeout = reunion_timeout
+        graph.reunion_timers = TimerWheel()
+        graph.reunion_level_delay = 0
+        graph.root = GraphNode(None, graph, root_id)
+        graph.nodes = _NodeTable(graph)
+
+        graph._free_slots = [graph.__slot_entry(node_id) for node_id in range(slots)
+                             if graph._key[node_id] != _NONE and graph._alive[node_id]
+                             and graph._child_count[node_id] < fan_out]
+        heapq.heapify(graph._free_slots)
+        graph.restart_reunion_timers()
+        return graph, offset
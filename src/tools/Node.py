@@ -2,7 +2,7 @@ from src.tools.simpletcp.clientsocket import ClientSocket
 
 
 class Node:
-    def __init__(self, server_address, set_root=False, set_register=False):
+    def __init__(self, server_address, set_root=False, set_register=False, ack_window=16):
         """
         The Node object constructor.
 
@@ -16,34 +16,53 @@ class Node:
         :param server_address:
         :param set_root:
         :param set_register:
+        :param ack_window: Number of messages that may wait for their ACK before sending blocks; None never waits
+                           and 1 is the old send-and-wait behaviour.
         """
         self.server_ip = Node.parse_ip(server_address[0])
         self.server_port = Node.parse_port(server_address[1])
         self.is_register = set_register
         self.is_root = set_root
+        self.packed_address = Node.pack_address((self.server_ip, self.server_port))
+        # Wire format of the packets we send to this node; Stream raises it once the node says it reads a newer one.
+        self.wire_version = 1
 
         print("Server Address: ", server_address)
 
         self.out_buff = []
+        # Totals over every send_message call.
+        self.bytes_flushed = 0
+        self.packets_flushed = 0
         # FIXME should we make any non-single_use sockets?
         try:
-            self.client = ClientSocket(self.server_ip, int(self.server_port), single_use=False)
+            self.client = ClientSocket(self.server_ip, int(self.server_port), single_use=False,
+                                       ack_window=ack_window)
         except:
             raise ConnectionRefusedError
 
         pass
 
-    def send_message(self):
+    def send_message(self, packets=None):
         """
         Final function to send buffer to the client's socket.
+        The whole buffer is written in one batch; a dead peer shows up as ConnectionResetError.
 
-        :return:
+        :param packets: Number of packets in the buffer if some of its entries are Bundles of several packets;
+                        None counts every entry as one packet.
+        :type packets: int
+
+        :return: Bytes and packets flushed by this call.
+        :rtype: tuple
         """
-        for msg in self.out_buff:
-            self.client.send(msg)
+        if not self.out_buff:
+            return 0, 0
+        sent_bytes = self.client.send_batch(self.out_buff)
+        sent_packets = len(self.out_buff) if packets is None else packets
+        self.bytes_flushed += sent_bytes
+        self.packets_flushed += sent_packets
         # FIXME the buffer might not need to be emptied
         self.out_buff.clear()
-        pass
+        return sent_bytes, sent_packets
 
     def add_message_to_out_buff(self, message):
         """
@@ -92,3 +111,34 @@ class Node:
         :rtype: str
         """
         return str(int(port)).zfill(5)
+
+    @staticmethod
+    def pack_address(address):
+        """
+        Pack an IP/Port address into a single integer: the 4 IP bytes followed by the 2 port bytes.
+        Every format of the same address, e.g. ('192.168.1.1', 5335) and ('192.168.001.001', '05335'), gives the same
+        integer.
+
+        :param address: Input IP/Port address.
+        :type address: tuple
+
+        :return: Packed address
+        :rtype: int
+        """
+        parts = address[0].split('.')
+        return (int(parts[0]) << 40) | (int(parts[1]) << 32) | (int(parts[2]) << 24) | (int(parts[3]) << 16) | \
+            int(address[1])
+
+    @staticmethod
+    def unpack_address(packed):
+        """
+        Inverse of pack_address.
+
+        :param packed: Packed address
+        :type packed: int
+
+        :return: Formatted address like ('192.168.001.001', '05335').
+        :rtype: tuple
+        """
+        return ('%03d.%03d.%03d.%03d' % ((packed >> 40) & 255, (packed >> 32) & 255, (packed >> 24) & 255,
+                                         (packed >> 16) & 255), '%05d' % (packed & 65535))
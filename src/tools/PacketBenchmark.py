@@ -0,0 +1,73 @@
+"""
+    Micro benchmark of the Packet codec.
+
+    It compares Packet encoding and decoding of a message against the codec Packet used to have, which packed and
+    unpacked the body one byte at a time. The 'header' line is what a hop that only looks at the type and the body
+    kind pays with the lazy PacketView returned by PacketFactory.parse_buffer.
+
+    Usage:
+        python -m src.tools.PacketBenchmark [body size in bytes]
+"""
+
+import struct
+import sys
+import timeit
+
+from src.Packet import Packet, PacketFactory
+from src.tools.Node import Node
+
+
+def legacy_encode(version, type, length, source_server_ip, source_server_port, body):
+    ip_int_list = list(map(int, source_server_ip.split('.')))
+    return struct.pack('!hhl4hl%dB' % len(body), version, type, length, *ip_int_list,
+                       int(source_server_port), *bytes(body, 'utf-8'))
+
+
+def legacy_decode(buf):
+    data = struct.unpack('!hhl4hl', bytes(buf[:20]))
+    ip_str = '.'.join(str(i) for i in data[3:7])
+    source_server_ip = Node.parse_ip(ip_str)
+    source_server_port = Node.parse_port(str(data[7]))
+    rest = struct.unpack('%dB' % len(buf[20:]), buf[20:])
+    body = ''.join(chr(i) for i in rest)
+    return data[0], data[1], data[2], source_server_ip, source_server_port, body
+
+
+def read_header_fields(buf):
+    packet = PacketFactory.parse_buffer(buf)
+    return packet.get_type(), packet.get_source_server_address(), packet.get_body_kind()
+
+
+def best_of(statement, number, repeat=5):
+    """
+
+    :return: Best time of one run of 'statement' in microseconds.
+    :rtype: float
+    """
+    return min(timeit.repeat(statement, number=number, repeat=repeat)) / number * 1e6
+
+
+def run(size=1024, number=2000):
+    message = 'x' * size
+    address = ('192.168.001.001', '05335')
+    buf = PacketFactory.new_message_packet(message, address).get_buf()
+    assert legacy_encode(1, 4, size, address[0], address[1], message) == buf
+    assert legacy_decode(buf)[5] == Packet(buf=buf).get_body() == message
+
+    results = [
+        ('encode', best_of(lambda: legacy_encode(1, 4, size, address[0], address[1], message), number),
+         best_of(lambda: PacketFactory.new_message_packet(message, address), number)),
+        ('decode', best_of(lambda: legacy_decode(buf), number),
+         best_of(lambda: Packet(buf=buf).get_body(), number)),
+        ('header', best_of(lambda: legacy_decode(buf), number),
+         best_of(lambda: read_header_fields(buf), number)),
+    ]
+    print('Packet codec, %d byte body' % size)
+    for name, legacy, current in results:
+        print('  %-6s  legacy %8.2f us   current %8.2f us   speedup %6.1fx' % (name, legacy, current,
+                                                                             legacy / current))
+    return results
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1024)
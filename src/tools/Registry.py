@@ -0,0 +1,164 @@
+import time
+from array import array
+from collections import deque
+
+from src.tools.Node import Node
+
+
+class Registry:
+    def __init__(self, expiry=None, clock=time.monotonic):
+        """
+        The registered addresses of the root.
+
+        Addresses are kept by Node.pack_address in a hash set, so every format of an address finds the same entry and
+        a lookup is O(1) however many peers are registered.
+
+        A new registration is pending until confirm() is called for it (when the peer advertises); expire() drops
+        the registrations that have been pending for 'expiry' seconds, i.e. peers that registered and went away.
+        The pending registrations are in a queue in the order they were made, so expire() only looks at the ones
+        that have expired (and at the ones confirmed before them).
+
+        :param expiry: Seconds a registration may stay pending; None for never expiring them. Only the
+                       registrations made while it is set can expire.
+        :param clock: Monotonic clock returning seconds.
+
+        :type expiry: float
+        """
+        self.expiry = expiry
+        self._clock = clock
+        self._keys = set()
+        # Registration time of every pending key, and (time, key) in the order they were made.
+        self._pending = {}
+        self._queue = deque()
+
+        # Counters.
+        self.lookups = 0
+        self.hits = 0
+        self.added = 0
+        self.duplicates = 0
+        self.removed = 0
+        self.expired = 0
+
+    def add(self, address, now=None):
+        """
+        Register 'address'; the registration is pending until it is confirmed.
+
+        :param address: IP/Port address in any format.
+        :param now: Current time of the clock; read from the clock if not given.
+
+        :type address: tuple
+
+        :return: Whether the address was not registered before.
+        :rtype: bool
+        """
+        key = Node.pack_address(address)
+        if key in self._keys:
+            self.duplicates += 1
+            return False
+        if now is None:
+            now = self._clock()
+        self._keys.add(key)
+        self._pending[key] = now
+        if self.expiry is not None:
+            self._queue.append((now, key))
+        self.added += 1
+        return True
+
+    def confirm(self, address):
+        """
+        Keep the registration of 'address' from expiring.
+
+        :param address: IP/Port address in any format.
+        :type address: tuple
+
+        :return:
+        """
+        self._pending.pop(Node.pack_address(address), None)
+
+    def remove(self, address):
+        """
+        Unregister 'address'.
+
+        :param address: IP/Port address in any format.
+        :type address: tuple
+
+        :return: Whether the address was registered.
+        :rtype: bool
+        """
+        key = Node.pack_address(address)
+        if key not in self._keys:
+            return False
+        self._keys.remove(key)
+        self._pending.pop(key, None)
+        self.removed += 1
+        return True
+
+    def expire(self, now=None):
+        """
+        Unregister every registration that has been pending for 'expiry' seconds.
+
+        :param now: Current time of the clock; read from the clock if not given.
+
+        :return: The expired addresses.
+        :rtype: list
+        """
+        if self.expiry is None:
+            return []
+        if now is None:
+            now = self._clock()
+        expired = []
+        queue = self._queue
+        while queue and queue[0][0] + self.expiry <= now:
+            registered_at, key = queue.popleft()
+            # Confirmed, removed or registered again after this entry was queued.
+            if self._pending.get(key) != registered_at:
+                continue
+            del self._pending[key]
+            self._keys.remove(key)
+            expired.append(Node.unpack_address(key))
+        # Skip the confirmed ones at the front, so the queue does not grow with them.
+        while queue and queue[0][1] not in self._pending:
+            queue.popleft()
+        self.expired += len(expired)
+        return expired
+
+    def is_pending(self, address):
+        """
+
+        :return: Whether 'address' is registered but not confirmed yet.
+        :rtype: bool
+        """
+        return Node.pack_address(address) in self._pending
+
+    def export_keys(self):
+        """
+
+        :return: The packed addresses of all of the registrations.
+        :rtype: array
+        """
+        return array('q', self._keys)
+
+    def import_keys(self, keys):
+        """
+        Register many packed addresses at once, e.g. from export_keys; They are confirmed already.
+
+        :param keys: Packed addresses.
+
+        :return:
+        """
+        before = len(self._keys)
+        self._keys.update(keys)
+        self.added += len(self._keys) - before
+
+    def __contains__(self, address):
+        self.lookups += 1
+        if Node.pack_address(address) in self._keys:
+            self.hits += 1
+            return True
+        return False
+
+    def __iter__(self):
+        return (Node.unpack_address(key) for key in self._keys)
+
+    def __len__(self):
+        return len(self._keys)
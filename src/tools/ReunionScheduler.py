@@ -0,0 +1,160 @@
+import random
+import time
+
+
+class ReunionScheduler:
+    def __init__(self, interval, min_interval, max_interval, retry, max_retry, jitter=0.5, clock=time.monotonic,
+                 rng=None):
+        """
+        Decides when a peer sends its next Reunion Hello (or Summary).
+
+        Peers that joined at the same moment would otherwise send their Hellos in lockstep forever, so the first
+        Hello is sent at a random point of the first interval, and every interval after it is stretched or shrunk
+        by a random factor of up to jitter / 2.
+
+        The interval is the one advertised by the root (see set_interval); It is not shortened when Hellos are lost,
+        as Hellos sent more often would only load the root more when it is already losing them. Losses are dealt with
+        by the retries instead: an unanswered Hello is sent again after 'retry' seconds, doubled for every further
+        miss up to 'max_retry', so a peer whose parent is gone does not flood the network. The measured loss is kept
+        in 'loss'.
+
+        All times are in seconds of 'clock'.
+
+        :param interval: Time between two answered Hellos.
+        :param min_interval: Lower bound of the interval.
+        :param max_interval: Upper bound of the interval.
+        :param retry: Time to wait for the answer of a Hello before sending it again.
+        :param max_retry: Upper bound of the backed off retry time.
+        :param jitter: Relative width of the random spread of the times.
+        :param clock: Monotonic clock returning seconds.
+        :param rng: Source of the random spread; a new random.Random if not given.
+
+        :type interval: float
+        :type min_interval: float
+        :type max_interval: float
+        :type retry: float
+        :type max_retry: float
+        :type jitter: float
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min(max(interval, min_interval), max_interval)
+        self.retry = retry
+        self.max_retry = max_retry
+        self.jitter = jitter
+        self._clock = clock
+        self._random = rng if rng is not None else random.Random()
+        # Exponential moving average of the fraction of unanswered Hellos, and the number of them in a row.
+        self.loss = 0.0
+        self.misses = 0
+        self.next_send = None
+        self.in_flight = False
+
+        # Counters.
+        self.sent = 0
+        self.answered = 0
+
+    def __spread(self, delay):
+        return delay * (1 + self.jitter * (self._random.random() - 0.5))
+
+    def __observe(self, lost):
+        self.loss += ((1.0 if lost else 0.0) - self.loss) / 8
+
+    def period(self):
+        """
+
+        :return: The time between two answered Hellos now, before the jitter.
+        :rtype: float
+        """
+        return self.interval
+
+    def retry_timeout(self):
+        """
+
+        :return: The time to wait for the answer of the next Hello, before the jitter.
+        :rtype: float
+        """
+        return min(self.retry * 2 ** min(self.misses, 16), self.max_retry)
+
+    def start(self, now=None):
+        """
+        Schedule the first Hello, at a random point of one interval from now; e.g. after joining a parent.
+
+        :param now: Current time of the clock; read from the clock if not given.
+
+        :return:
+        """
+        if now is None:
+            now = self._clock()
+        self.in_flight = False
+        self.misses = 0
+        self.next_send = now + self._random.random() * self.period()
+
+    def stop(self):
+        """
+        Don't schedule any Hello until start is called again.
+
+        :return:
+        """
+        self.next_send = None
+        self.in_flight = False
+
+    def due(self, now=None):
+        """
+
+        :param now: Current time of the clock; read from the clock if not given.
+
+        :return: Whether a Hello should be sent now; a retry if in_flight is set.
+        :rtype: bool
+        """
+        if self.next_send is None:
+            return False
+        if now is None:
+            now = self._clock()
+        return now >= self.next_send
+
+    def on_sent(self, now=None):
+        """
+        Called when a Hello is sent; The previous one counts as lost if it is still unanswered.
+
+        :param now: Current time of the clock; read from the clock if not given.
+
+        :return:
+        """
+        if now is None:
+            now = self._clock()
+        if self.in_flight:
+            self.misses += 1
+            self.__observe(True)
+        self.in_flight = True
+        self.sent += 1
+        self.next_send = now + self.__spread(self.retry_timeout())
+
+    def on_answered(self, now=None):
+        """
+        Called when the answer of our Hello arrives; The next Hello is scheduled one jittered period later.
+
+        :param now: Current time of the clock; read from the clock if not given.
+
+        :return:
+        """
+        if now is None:
+            now = self._clock()
+        if self.in_flight:
+            self.__observe(False)
+            self.answered += 1
+        self.in_flight = False
+        self.misses = 0
+        if self.next_send is not None:
+            self.next_send = now + self.__spread(self.period())
+
+    def set_interval(self, interval):
+        """
+        Take the interval that the root advertised.
+
+        :param interval: Time between two answered Hellos in seconds.
+        :type interval: float
+
+        :return:
+        """
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
@@ -0,0 +1,182 @@
+import math
+import time
+from array import array
+
+
+class TimerWheel:
+    def __init__(self, resolution=1.0, slots=64, clock=time.monotonic):
+        """
+        A hashed timer wheel.
+
+        Timers are kept in 'slots' buckets; a timer with deadline d sits in the bucket of tick ceil(d / resolution).
+        Arming, re-arming and cancelling a timer is O(1), and expire() only visits the buckets of the ticks that
+        passed since the last call, so it touches the expired timers (plus those that are one or more full turns
+        of the wheel away, if any timeout is longer than slots * resolution).
+
+        Keys are small non-negative integers, like NetworkGraph node ids. The timers live in flat arrays indexed by
+        key and every bucket is a doubly linked list threaded through them, so a timer costs about 20 bytes.
+
+        :param resolution: Length of one tick of the wheel in seconds.
+        :param slots: Number of buckets in the wheel.
+        :param clock: Monotonic clock returning seconds.
+
+        :type resolution: float
+        :type slots: int
+        """
+        self.resolution = resolution
+        self.slots = slots
+        self._clock = clock
+        # First key of every bucket's list, -1 if the bucket is empty.
+        self._heads = array('i', [-1]) * slots
+        # Per key: deadline, neighbours in the bucket list and the bucket (-1 when the timer is not running).
+        self._deadline = array('d')
+        self._next = array('i')
+        self._prev = array('i')
+        self._bucket = array('i')
+        self._count = 0
+        # The first tick that expire() has not processed yet.
+        self._cursor = self.__tick_of(self._clock())
+
+    def __tick_of(self, timestamp):
+        return int(math.floor(timestamp / self.resolution))
+
+    def __link(self, key, index):
+        head = self._heads[index]
+        self._next[key] = head
+        self._prev[key] = -1
+        if head >= 0:
+            self._prev[head] = key
+        self._heads[index] = key
+        self._bucket[key] = index
+
+    def __unlink(self, key):
+        index = self._bucket[key]
+        next_key = self._next[key]
+        prev_key = self._prev[key]
+        if prev_key >= 0:
+            self._next[prev_key] = next_key
+        else:
+            self._heads[index] = next_key
+        if next_key >= 0:
+            self._prev[next_key] = prev_key
+        self._bucket[key] = -1
+
+    def arm(self, key, timeout, now=None):
+        """
+        Start the timer of 'key', or restart it if it is already running.
+
+        :param key: A non-negative integer.
+        :param timeout: Seconds until the timer expires.
+        :param now: Current time of the clock; read from the clock if not given.
+
+        :return:
+        """
+        if now is None:
+            now = self._clock()
+        missing = key + 1 - len(self._bucket)
+        if missing > 0:
+            self._deadline.extend([0.0] * missing)
+            self._next.extend([-1] * missing)
+            self._prev.extend([-1] * missing)
+            self._bucket.extend([-1] * missing)
+        self.cancel(key)
+        deadline = now + timeout
+        tick = max(int(math.ceil(deadline / self.resolution)), self._cursor)
+        self._deadline[key] = deadline
+        self.__link(key, tick % self.slots)
+        self._count += 1
+
+    def arm_many(self, keys, timeout, now=None):
+        """
+        Start the timers of all of 'keys' with the same timeout; Like arm for every key, but faster for many keys.
+
+        :param keys: Non-negative integers.
+        :param timeout: Seconds until the timers expire.
+        :param now: Current time of the clock; read from the clock if not given.
+
+        :return:
+        """
+        if now is None:
+            now = self._clock()
+        keys = list(keys)
+        if not keys:
+            return
+        missing = max(keys) + 1 - len(self._bucket)
+        if missing > 0:
+            self._deadline.extend([0.0] * missing)
+            self._next.extend([-1] * missing)
+            self._prev.extend([-1] * missing)
+            self._bucket.extend([-1] * missing)
+        deadline = now + timeout
+        index = max(int(math.ceil(deadline / self.resolution)), self._cursor) % self.slots
+        for key in keys:
+            self.cancel(key)
+            self._deadline[key] = deadline
+            self.__link(key, index)
+        self._count += len(keys)
+
+    def cancel(self, key):
+        """
+        Stop the timer of 'key'; Nothing happens if it is not running.
+
+        :param key: A non-negative integer.
+
+        :return: Whether the timer was running.
+        :rtype: bool
+        """
+        if key not in self:
+            return False
+        self.__unlink(key)
+        self._count -= 1
+        return True
+
+    def expire(self, now=None):
+        """
+        Remove and return every timer whose deadline has passed.
+
+        :param now: Current time of the clock; read from the clock if not given.
+
+        :return: Keys of the expired timers.
+        :rtype: list
+        """
+        if now is None:
+            now = self._clock()
+        now_tick = self.__tick_of(now)
+        if now_tick < self._cursor:
+            return []
+        expired = []
+        # Even if we were not called for a long time one turn of the wheel is enough.
+        last_tick = min(now_tick, self._cursor + self.slots - 1)
+        for tick in range(self._cursor, last_tick + 1):
+            key = self._heads[tick % self.slots]
+            while key >= 0:
+                next_key = self._next[key]
+                if self._deadline[key] <= now:
+                    self.__unlink(key)
+                    self._count -= 1
+                    expired.append(key)
+                key = next_key
+        self._cursor = now_tick + 1
+        return expired
+
+    def now(self):
+        """
+
+        :return: Current time of the wheel's clock.
+        :rtype: float
+        """
+        return self._clock()
+
+    def deadline(self, key):
+        """
+
+        :return: Deadline of the timer of 'key', or None if it is not running.
+        :rtype: float
+        """
+        return self._deadline[key] if key in self else None
+
+    def __contains__(self, key):
+        return 0 <= key < len(self._bucket) and self._bucket[key] >= 0
+
+    def __len__(self):
+        return self._count
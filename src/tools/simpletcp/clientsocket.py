@@ -2,8 +2,14 @@ import sys
 import socket
 
 
+# The response the server sends back for every message it receives.
+ACK = b'ACK'
+# Most systems refuse more buffers than this (IOV_MAX) in one sendmsg call.
+_MAX_IOV = 512
+
+
 class ClientSocket:
-    def __init__(self, mode, port, received_bytes=2048, single_use=True):
+    def __init__(self, mode, port, received_bytes=2048, single_use=True, ack_window=None):
         """
 
         Handle the socket's mode.
@@ -12,6 +18,9 @@ class ClientSocket:
         localhost -> (127.0.0.1)
         public ->    (0.0.0.0)
         otherwise, mode is interpreted as an IP address.
+
+        ack_window is only used by send_pipelined: it is the number of messages that may be
+        in flight without an ACK before sending blocks. None means never wait for ACKs.
         """
 
         if mode == "localhost":
@@ -39,6 +48,11 @@ class ClientSocket:
         # Keep track of whether this socket has been used, so we can
         # warn single-use sockets not to send data twice.
         self.used = False
+        # Pipelined mode: messages sent but not acknowledged yet, and the
+        # bytes of an ACK that has only partly arrived.
+        self.ack_window = ack_window
+        self.unacked = 0
+        self._ack_bytes = 0
 
     def get_port(self):
         return self.connect_port
@@ -98,6 +112,121 @@ class ClientSocket:
         # Return the response
         return response
 
+    def send_pipelined(self, data):
+        """
+
+        Send data without waiting for the server's response to it.
+
+        ACKs of earlier messages are collected as they arrive; the call only blocks
+        when ack_window messages are still waiting for their ACK.
+        A peer that has gone away is reported with ConnectionResetError, whether it is
+        noticed while sending or while reading ACKs.
+
+        This method can not be used with single-use sockets.
+
+        """
+
+        if self.single_use:
+            print("single-use sockets can not send pipelined data", file=sys.stderr)
+            raise RuntimeError
+        # If data is a string, rather than bytes.
+        if type(data) == str:
+            # Turn it into UTF-8 bytes.
+            data = bytes(data, "UTF-8")
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            print("data must be a string or bytes", file=sys.stderr)
+            raise ValueError
+        try:
+            self._socket.sendall(data)
+        except ConnectionError:
+            raise ConnectionResetError
+        self.used = True
+        self.unacked += 1
+        self.collect_acks()
+
+    def send_batch(self, buffers):
+        """
+
+        Send several messages with as few system calls as possible and without
+        waiting for their responses, like send_pipelined.
+
+        Where socket.sendmsg is available the buffers are written as one vector
+        straight from memoryviews; partial writes are continued from the first
+        unwritten byte. Otherwise the joined buffers are written with sendall.
+
+        :return: The number of bytes written.
+        """
+
+        if self.single_use:
+            print("single-use sockets can not send pipelined data", file=sys.stderr)
+            raise RuntimeError
+        views = []
+        for data in buffers:
+            if type(data) == str:
+                data = bytes(data, "UTF-8")
+            if not isinstance(data, (bytes, bytearray, memoryview)):
+                print("data must be a string or bytes", file=sys.stderr)
+                raise ValueError
+            views.append(memoryview(data).cast('B'))
+        total = 0
+        try:
+            if hasattr(self._socket, 'sendmsg'):
+                i = 0
+                while i < len(views):
+                    sent = self._socket.sendmsg(views[i:i + _MAX_IOV])
+                    total += sent
+                    # Skip the buffers that were written completely and cut
+                    # the written head off the one that was written partly.
+                    while i < len(views) and sent >= views[i].nbytes:
+                        sent -= views[i].nbytes
+                        i += 1
+                    if sent:
+                        views[i] = views[i][sent:]
+            else:
+                data = b''.join(views)
+                self._socket.sendall(data)
+                total = len(data)
+        except ConnectionError:
+            raise ConnectionResetError
+        self.used = True
+        self.unacked += len(views)
+        self.collect_acks()
+        return total
+
+    def collect_acks(self):
+        """
+
+        Read the ACKs that have already arrived without blocking, unless
+        the ACK window is full; then wait until there is room in it again.
+
+        :return: Number of messages still waiting for their ACK.
+        """
+
+        while self.unacked:
+            block = self.ack_window is not None and self.unacked >= self.ack_window
+            try:
+                if block:
+                    data = self._socket.recv(self.received_bytes)
+                else:
+                    self._socket.setblocking(False)
+                    try:
+                        data = self._socket.recv(self.received_bytes)
+                    finally:
+                        self._socket.setblocking(True)
+            except (BlockingIOError, InterruptedError):
+                # Nothing to read right now.
+                break
+            except ConnectionError:
+                raise ConnectionResetError
+            if not data:
+                # The other side has closed the connection.
+                raise ConnectionResetError
+            # ACKs may be split or merged by TCP, so only count whole ones.
+            self._ack_bytes += len(data)
+            self.unacked = max(0, self.unacked - self._ack_bytes // len(ACK))
+            self._ack_bytes %= len(ACK)
+        return self.unacked
+
     def close(self):
         # If the connection isn't already closed, close it.
         if not self.closed:
@@ -1,13 +1,15 @@
 import errno
 import queue
 import select
+import selectors
 import socket
 import sys
 
 
 class ServerSocket:
 
-    def __init__(self, mode, port, read_callback, max_connections, received_bytes):
+    def __init__(self, mode, port, read_callback, max_connections, received_bytes, use_selectors=True,
+                 close_callback=None):
         """
         Handle the socket's mode.
         The socket's mode determines the IP address it binds to.
@@ -15,6 +17,11 @@ class ServerSocket:
         localhost -> (127.0.0.1)
         public ->    (0.0.0.0)
         otherwise, mode is interpreted as an IP address.
+
+        use_selectors chooses the event loop: the selectors (epoll/kqueue) based loop
+        when True, or the legacy select.select loop when False.
+        close_callback, if given, is called with the IP address of every connection
+        that gets closed, so per-connection state kept by the caller can be freed.
         """
 
         if mode == "localhost":
@@ -33,10 +40,13 @@ class ServerSocket:
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Make it non-blocking.
         self._socket.setblocking(0)
+        # Let a restarted server bind its port again while connections of the old one are in TIME_WAIT.
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         # Bind the socket, so it can listen.
         self._socket.bind((self.ip, self.port))
-        # Save the callback
+        # Save the callbacks
         self.callback = read_callback
+        self.close_callback = close_callback
         # Save the number of maximum connections.
         self._max_connections = max_connections
         if type(self._max_connections) != int:
@@ -45,8 +55,104 @@ class ServerSocket:
         # Save the number of bytes to be received each time we read from
         # a socket
         self.received_bytes = received_bytes
+        # Save which event loop run() should use.
+        self.use_selectors = use_selectors
 
     def run(self):
+        if self.use_selectors:
+            self._run_selectors()
+        else:
+            self._run_select()
+
+    def _run_selectors(self):
+        # Start listening
+        self._socket.listen(self._max_connections)
+        # DefaultSelector picks epoll/kqueue where available, so the cost of
+        # one iteration depends on the ready sockets only and there is no
+        # FD_SETSIZE limit.
+        selector = selectors.DefaultSelector()
+        # The listening socket carries no connection state.
+        selector.register(self._socket, selectors.EVENT_READ, None)
+        # Create a dictionary of connections.
+        # This dictionary maps file descriptors to _Connection objects.
+        connections = dict()
+        # Now, the main loop.
+        while selector.get_map():
+            # Block until a socket is ready for processing.
+            for key, mask in selector.select():
+                conn = key.data
+                if conn is None:
+                    # We have a viable connection!
+                    client_socket, client_ip = self._socket.accept()
+                    # Make it a non-blocking connection.
+                    client_socket.setblocking(0)
+                    conn = _Connection(client_socket, client_ip)
+                    connections[conn.fd] = conn
+                    # Only ask for write readiness once there is something to write.
+                    selector.register(client_socket, selectors.EVENT_READ, conn)
+                    continue
+                if mask & selectors.EVENT_READ:
+                    # Someone sent us something! Let's receive it.
+                    try:
+                        data = conn.sock.recv(self.received_bytes)
+                    except socket.error:
+                        data = None
+                    if not data:
+                        # We received zero bytes, so we should close the stream.
+                        self._close_connection(selector, connections, conn)
+                        continue
+                    # Call the callback
+                    self.callback(conn.address, conn.queue, data)
+                if not self._flush_connection(conn):
+                    self._close_connection(selector, connections, conn)
+                    continue
+                # Watch for write readiness only while data is still pending.
+                events = selectors.EVENT_READ
+                if conn.pending:
+                    events |= selectors.EVENT_WRITE
+                if events != key.events:
+                    selector.modify(conn.sock, events, conn)
+
+    @staticmethod
+    def _flush_connection(conn):
+        """
+        Write as much of the connection's queued data as the socket accepts right now.
+
+        :return: False if the connection is broken and should be closed.
+        :rtype: bool
+        """
+        # Move everything from the queue into the pending buffer.
+        while True:
+            try:
+                conn.pending += conn.queue.get_nowait()
+            except queue.Empty:
+                break
+        while conn.pending:
+            try:
+                sent = conn.sock.send(conn.pending)
+            except (BlockingIOError, InterruptedError):
+                # The socket buffer is full; wait for the next write event.
+                return True
+            except socket.error:
+                return False
+            # Drop the part that has been written, keep the rest for later.
+            del conn.pending[:sent]
+        return True
+
+    def _close_connection(self, selector, connections, conn):
+        # Stop watching it.
+        selector.unregister(conn.sock)
+        # Close the connection.
+        conn.sock.close()
+        # Destroy its state.
+        del connections[conn.fd]
+        self._notify_close(conn.address)
+
+    def _notify_close(self, address):
+        if self.close_callback is not None:
+            self.close_callback(address)
+
+    def _run_select(self):
         # Start listening
         self._socket.listen(self._max_connections)
         # Create a list of readers (sockets that will be read from) and a list
@@ -106,6 +212,7 @@ class ServerSocket:
                         sock.close()
                         # Destroy is queue
                         del queues[sock]
+                        self._notify_close(IPs.pop(sock))
             # Deal with sockets that need to be written to.
             for sock in write:
                 try:
@@ -128,3 +235,20 @@ class ServerSocket:
                 sock.close()
                 # Destroy its queue.
                 del queues[sock]
+                self._notify_close(IPs.pop(sock))
+
+
+class _Connection:
+    """
+    Per-connection state of the selectors based loop.
+    """
+    __slots__ = ('sock', 'fd', 'address', 'queue', 'pending')
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        # The file descriptor is saved because it is not available after close().
+        self.fd = sock.fileno()
+        self.address = address
+        self.queue = queue.Queue()
+        # Bytes taken from the queue that the socket has not accepted yet.
+        self.pending = bytearray()
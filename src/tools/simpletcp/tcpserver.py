@@ -17,12 +17,16 @@ class TCPServer:
      is a tunnel of data to send to the socket that it received from.
      The third argument must be data, which is a string of bytes
      that the server received.
+     use_selectors chooses the selectors (epoll/kqueue) based event loop; set it
+     to False to fall back to the select.select loop.
+     close_callback, if given, is called with the IP address of a connection
+     when it is closed.
     """
 
     def __init__(self, mode, port, read_callback,
-                 maximum_connections=5, receive_bytes=2048):
+                 maximum_connections=5, receive_bytes=2048, use_selectors=True, close_callback=None):
         self.server_socket = ServerSocket(
-            mode, port, read_callback, maximum_connections, receive_bytes
+            mode, port, read_callback, maximum_connections, receive_bytes, use_selectors, close_callback
         )
 
     def run(self):